@@ -1,14 +1,17 @@
 import math
 from typing import Dict, List, Optional, Tuple
 
-import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from einops import rearrange, repeat
-from torchmetrics import R2Score
 
-from einops import rearrange, repeat
+try:
+    from torch_scatter import segment_coo
+except ImportError:
+    segment_coo = None
+
+# scatter_reduce pool names and the matching segment_coo reductions
+SEGMENT_COO_REDUCE = {"sum": "sum", "mean": "mean", "amax": "max", "amin": "min"}
 
 from torch_brain.nn import InfiniteVocabEmbedding
 
@@ -47,13 +50,63 @@ from torch_brain.nn import InfiniteVocabEmbedding
 #         return batch
 
 
+def apply_patch_mask(spikes: torch.Tensor, mask: torch.Tensor) -> torch.Tensor:
+    """Zeroes the masked patches of `spikes` (B, T*N, P, Q) given a patch mask
+    (B, T*N). The mask is broadcast over (P, Q) with a multiply, and is never
+    expanded to the full size of `spikes`.
+    """
+    return spikes * (~mask).to(spikes.dtype)[:, :, None, None]
+
+
+def apply_neuron_mask(
+    spikes: torch.Tensor,
+    space_idx: torch.Tensor,
+    num_spatial_patches: int,
+    mask_ratio: float,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Samples a per-sample neuron mask and zeroes the masked patches of `spikes`.
+    The mask is broadcast and never expanded to the full size.
+
+    Args:
+        spikes (torch.Tensor): Spike tokens (B, T*N, P, Q)
+        space_idx (torch.Tensor): Space index of each patch (T*N,)
+        num_spatial_patches (Int): Number of space patches N
+        mask_ratio (Float): Masking probability of each space patch
+    Returns: masked spikes (B, T*N, P, Q) and patch mask (B, T*N)
+    """
+    mask = spikes.new_empty(spikes.shape[0], num_spatial_patches, dtype=torch.float)
+    mask = mask.bernoulli_(mask_ratio).bool()
+    mask = mask[:, space_idx]
+    return spikes * (~mask).to(spikes.dtype)[:, :, None, None], mask
+
+
 # class MTMMaskManager(nn.Module):
 class MaeMaskManager(nn.Module):
-    def __init__(self, mask_ratio: float, mode: str = "neuron"):
+    def __init__(
+        self,
+        mask_ratio: float,
+        mode: str = "neuron",
+        num_temporal_patches: Optional[int] = None,
+        num_spatial_patches: Optional[int] = None,
+    ):
+        """
+        Args:
+            mask_ratio (Float): Fraction of the patches to mask
+            mode (Str): One of "temporal", "neuron", "forward-pred" or "random"
+            num_temporal_patches (Int): Number of time patches of the patchification
+                grid. If None, inferred from the batch and cached per input shape.
+            num_spatial_patches (Int): Number of space patches of the patchification
+                grid. If None, inferred from the batch and cached per input shape.
+        """
         super().__init__()
         self.mask_ratio = mask_ratio
         self.mode = mode
+        self.num_temporal_patches = num_temporal_patches
+        self.num_spatial_patches = num_spatial_patches
+        # (num_temporal_patches, num_spatial_patches) for each number of patches
+        self._grid_cache = {}
 
+    @torch.no_grad()
     def forward(self, batch: dict, eval_mode: bool = False) -> dict:
         """
         Parameters:
@@ -68,9 +121,20 @@ class MaeMaskManager(nn.Module):
         space_idx = batch["space_idx"]  # (B, T*N,)
 
         B, total_patches, P, Q = spikes.shape
-        num_temporal_patches = len(torch.unique(time_idx))
-        num_spatial_patches = len(torch.unique(space_idx))
-        keys = ["spike_tokens", "time_idx", "space_idx", "channel_counts"]
+        # the patchification grid depends on the number of neurons, which changes
+        # across sessions, so it is cached per input shape; the patches form a
+        # (T, N) grid, so once T is known N follows from the shape without a sync
+        grid = self._grid_cache.get(total_patches)
+        if grid is None:
+            num_temporal_patches = self.num_temporal_patches
+            if num_temporal_patches is None:
+                num_temporal_patches = int(time_idx.max()) + 1
+            num_spatial_patches = self.num_spatial_patches
+            if num_spatial_patches is None:
+                num_spatial_patches = total_patches // num_temporal_patches
+            grid = (num_temporal_patches, num_spatial_patches)
+            self._grid_cache[total_patches] = grid
+        num_temporal_patches, num_spatial_patches = grid
 
         # print("\n=== Masking Debug ===")
         # print(f"Batch size: {B}, Total patches: {total_patches}")
@@ -83,10 +147,7 @@ class MaeMaskManager(nn.Module):
             # In evaluation mode, return all data as targets and skip masking
             batch["shuffle"] = torch.arange(spikes.size(1), device=spikes.device)
             batch["encoder_frac"] = spikes.size(1)
-            for k in keys:
-                batch[f"{k}_target"] = batch[k]
-            print("Eval mode - No masking applied")
-            print("======================\n")
+            batch["spike_tokens_target"] = spikes
             return batch
 
         # Step 1: Generate the mask based on the mode
@@ -98,9 +159,9 @@ class MaeMaskManager(nn.Module):
             # mask = mask.unsqueeze(0).expand(B, total_patches)   # Expand to (B, T*N)
 
         elif self.mode == "neuron":
-            mask_probs = torch.full((B, num_spatial_patches),self.mask_ratio,device=spikes.device)
-            mask = torch.bernoulli(mask_probs).bool()
-            mask = mask[:, space_idx[0]]  # Expand to (B, T*N)
+            masked_spikes, mask = apply_neuron_mask(
+                spikes, space_idx[0], num_spatial_patches, self.mask_ratio
+            )
 
         elif self.mode == "forward-pred":
             mask = torch.zeros(num_temporal_patches, device=spikes.device)
@@ -109,30 +170,22 @@ class MaeMaskManager(nn.Module):
             mask = mask[time_idx]  # Expand to (T*N,)
 
         elif self.mode == "random":
-            mask = torch.bernoulli(torch.full((B, total_patches), self.mask_ratio, device=spikes.device)).bool()
+            mask = torch.empty(B, total_patches, device=spikes.device)
+            mask = mask.bernoulli_(self.mask_ratio).bool()
 
         else:
             raise ValueError(f"Unknown mode: {self.mode}")
 
-        # Step 2: Expand mask to full shape (B, T*N, P, Q)
+        # Step 2: Mask the data, the (B, T*N) mask is broadcast over (P, Q)
         mask = mask.bool()
         batch["spike_tokens_target_mask"] = mask
-        expanded_mask = mask.unsqueeze(-1).unsqueeze(-1)  # (B, T*N, 1, 1)
-        expanded_mask = expanded_mask.expand(B, total_patches, P, Q)
-
-        # Step 3: Mask the data
-        for k in keys:
-            if k == "spike_tokens":
-                # Store a copy of the original data for targets
-                batch[f"{k}_target"] = batch[k].clone()
-    
-                # Apply the mask to the original data
-                batch[k] = batch[k].masked_fill(expanded_mask, 0)
-            else:
-                # Other keys are not affected by masking
-                # batch[f"{k}_target"] = batch[k].clone()
-                batch[f"{k}_target"] = batch[k]
+        if self.mode != "neuron":
+            masked_spikes = apply_patch_mask(spikes, mask)
 
+        # Step 3: Store targets, masking is out-of-place so the unmasked input is kept
+        # as the target. Other keys are not affected by masking.
+        batch["spike_tokens_target"] = spikes
+        batch["spike_tokens"] = masked_spikes
 
         # Update metadata
         batch["encoder_frac"] = int((1 - self.mask_ratio) * total_patches)
@@ -161,8 +214,7 @@ class SpikesPatchifier(nn.Module):
             x (torch.Tensor): Binned spikes (bs, T, patch_size[0], patch_size[1])
         Returns: (NxT, D)
         """
-        x = rearrange(spikes, "bs T Pn Pt -> bs T (Pn Pt)")
-        return self.readin(x).flatten(-2, -1)
+        return self.readin(spikes.flatten(-2)).flatten(-2)
 
 
 class ContextManager(nn.Module):
@@ -180,9 +232,6 @@ class ContextManager(nn.Module):
     def get_ctx(self, batch: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
         return {k: batch.get(f"{k}_idx") for k in self.keys}
 
-    def get_emb(self, key: str, token: torch.Tensor) -> torch.Tensor:
-        return getattr(self, f"{key}_emb")(token) + getattr(self, f"{key}_flag")
-
     def init_vocab(self, vocab: Dict[str, List[str]]):
         for k, ids in vocab.items():
             getattr(self, f"{k}_emb").initialize_vocab(ids)
@@ -197,11 +246,16 @@ class ContextManager(nn.Module):
     def forward(
         self, batch: Dict[str, torch.Tensor], type: torch.Tensor
     ) -> torch.Tensor:
-        ctx_emb = [
-            self.get_emb(ctx_key, ctx_token).to(dtype=type)
-            for ctx_key, ctx_token in self.get_ctx(batch).items()
-        ]
-        return torch.stack(ctx_emb, dim=1)
+        ctx_emb = torch.stack(
+            [
+                getattr(self, f"{ctx_key}_emb")(ctx_token)
+                for ctx_key, ctx_token in self.get_ctx(batch).items()
+            ],
+            dim=1,
+        )
+        # one broadcast add and one cast for all keys, (B, K, dim) + (K, dim)
+        flags = torch.stack([getattr(self, f"{k}_flag") for k in self.keys])
+        return (ctx_emb + flags).to(dtype=type)
 
 
 class PositionalEncoding(nn.Module):
@@ -225,8 +279,112 @@ class PositionalEncoding(nn.Module):
             self.time_emb = nn.Embedding(max_time_patches, dim)
             self.space_emb = nn.Embedding(max_space_patches, dim)
 
-    def forward(self, times: torch.Tensor, spaces: torch.Tensor) -> torch.Tensor:
-        return self.time_emb(times) + self.space_emb(spaces)
+    def forward(
+        self,
+        times: torch.Tensor,
+        spaces: torch.Tensor,
+        src: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        # accumulate in place in the gathered time embedding, the embedding backward
+        # does not need its output, so no extra (B, T, D) buffers are allocated
+        emb = self.time_emb(times).add_(self.space_emb(spaces))
+        if src is not None:
+            emb = emb.add_(src)
+        return emb
+
+
+class SelfAttention(nn.Module):
+    """Multi-head self-attention computed with `F.scaled_dot_product_attention`.
+
+    Parameters are named as in `nn.MultiheadAttention` so that checkpoints saved with
+    `nn.TransformerEncoderLayer` load unchanged.
+    """
+
+    def __init__(self, dim: int, heads: int, dropout: float):
+        super().__init__()
+        self.heads = heads
+        self.dropout = dropout
+
+        self.in_proj_weight = nn.Parameter(torch.empty(3 * dim, dim))
+        self.in_proj_bias = nn.Parameter(torch.zeros(3 * dim))
+        self.out_proj = nn.Linear(dim, dim)
+
+        nn.init.xavier_uniform_(self.in_proj_weight)
+        nn.init.zeros_(self.out_proj.bias)
+
+    def forward(self, x: torch.Tensor, attn_mask: torch.Tensor) -> torch.Tensor:
+        b, t, _ = x.shape
+        qkv = F.linear(x, self.in_proj_weight, self.in_proj_bias)
+        q, k, v = qkv.view(b, t, 3, self.heads, -1).permute(2, 0, 3, 1, 4)
+
+        out = F.scaled_dot_product_attention(
+            q,
+            k,
+            v,
+            attn_mask=attn_mask,
+            dropout_p=self.dropout if self.training else 0.0,
+        )
+        out = out.transpose(1, 2).reshape(b, t, -1)
+        return self.out_proj(out)
+
+
+class TransformerLayer(nn.Module):
+    """Drop-in replacement for `nn.TransformerEncoderLayer` (batch first) that takes
+    a single boolean attention mask broadcastable to `(B, heads, T, T)`.
+    """
+
+    def __init__(
+        self,
+        dim: int,
+        heads: int,
+        dim_feedforward: int,
+        dropout: float,
+        activation: str = "gelu",
+        norm_first: bool = False,
+    ):
+        super().__init__()
+        self.self_attn = SelfAttention(dim, heads, dropout)
+
+        self.linear1 = nn.Linear(dim, dim_feedforward)
+        self.dropout = nn.Dropout(dropout)
+        self.linear2 = nn.Linear(dim_feedforward, dim)
+
+        self.norm_first = norm_first
+        self.norm1 = nn.LayerNorm(dim)
+        self.norm2 = nn.LayerNorm(dim)
+        self.dropout1 = nn.Dropout(dropout)
+        self.dropout2 = nn.Dropout(dropout)
+
+        self.activation = getattr(F, activation)
+
+    def forward(self, x: torch.Tensor, attn_mask: torch.Tensor) -> torch.Tensor:
+        if self.norm_first:
+            x = x + self._sa_block(self.norm1(x), attn_mask)
+            x = x + self._ff_block(self.norm2(x))
+        else:
+            x = self.norm1(x + self._sa_block(x, attn_mask))
+            x = self.norm2(x + self._ff_block(x))
+        return x
+
+    def _sa_block(self, x: torch.Tensor, attn_mask: torch.Tensor) -> torch.Tensor:
+        return self.dropout1(self.self_attn(x, attn_mask))
+
+    def _ff_block(self, x: torch.Tensor) -> torch.Tensor:
+        x = self.linear2(self.dropout(self.activation(self.linear1(x))))
+        return self.dropout2(x)
+
+
+class TransformerEncoder(nn.Module):
+    def __init__(self, layer_kwargs: Dict, depth: int):
+        super().__init__()
+        self.layers = nn.ModuleList(
+            [TransformerLayer(**layer_kwargs) for _ in range(depth)]
+        )
+
+    def forward(self, x: torch.Tensor, attn_mask: torch.Tensor) -> torch.Tensor:
+        for layer in self.layers:
+            x = layer(x, attn_mask)
+        return x
 
 
 class Transformer(nn.Module):
@@ -265,17 +423,21 @@ class Transformer(nn.Module):
         self.pre_norm = pre_norm
         self.ffn_mult = ffn_mult
         self.causal = causal
+        self._causal_mask_cache = {}
+        # token positions, sliced instead of re-allocated on every forward
+        self.register_buffer(
+            "_ar", torch.arange(max_time_patches * max_space_patches), persistent=False
+        )
 
-        enc_layer = nn.TransformerEncoderLayer(
-            dim,
-            heads,
+        enc_layer_kwargs = dict(
+            dim=dim,
+            heads=heads,
             dim_feedforward=int(dim * ffn_mult),
             dropout=dropout,
-            batch_first=True,
             activation=activation,
             norm_first=pre_norm,
         )
-        self.transformer = nn.TransformerEncoder(enc_layer, depth)
+        self.transformer = TransformerEncoder(enc_layer_kwargs, depth)
 
         self.positional_encoding = PositionalEncoding(
             dim, max_time_patches, max_space_patches, allow_embed_padding
@@ -292,60 +454,67 @@ class Transformer(nn.Module):
         spaces: torch.Tensor,
         pad_mask: torch.Tensor,
     ) -> torch.Tensor:
-        src = self.dropout_in(src)
-        src = src + self.positional_encoding(times, spaces)
+        src = self.embed_input(src, times, spaces)
 
-        # Debug prints to understand shapes
         original_src_len = src.shape[1]
-        
-        try:
-            if isinstance(ctx_emb, (list, tuple)):
-                ctx_emb = torch.stack(ctx_emb, dim=1)
-            nb_ctx_token = ctx_emb.shape[1]
-            src = torch.cat([src, ctx_emb], dim=1)
-            
-            # Calculate the total expected sequence length
-            total_seq_len = original_src_len + nb_ctx_token
-            
-            # Ensure pad_mask matches the total sequence length
-            if pad_mask.shape[1] != total_seq_len:
-                # First ensure pad_mask matches original src length
-                if pad_mask.shape[1] != original_src_len:
-                    raise ValueError(f"Padding mask length ({pad_mask.shape[1]}) doesn't match source length ({original_src_len})")
-                # Then extend it for context tokens
-                pad_mask = F.pad(pad_mask, (0, nb_ctx_token), value=False)
-        except Exception as e:
-            print(f"Error in transformer forward: {e}")
-            print(f"Shapes - src: {src.shape}, ctx_emb: {ctx_emb.shape}, pad_mask: {pad_mask.shape}")
-            raise
-
-        src_mask = self.make_src_mask(times, nb_ctx_token)
+        if isinstance(ctx_emb, (list, tuple)):
+            ctx_emb = torch.stack(ctx_emb, dim=1)
+        nb_ctx_token = ctx_emb.shape[1]
+        src = torch.cat([src, ctx_emb], dim=1)
+
+        # extend the padding mask for context tokens
+        if pad_mask.shape[1] == original_src_len:
+            pad_mask = F.pad(pad_mask, (0, nb_ctx_token), value=False)
 
         # Add shape verification before transformer call
         if pad_mask.shape[1] != src.shape[1]:
             raise ValueError(f"Mask shape {pad_mask.shape} doesn't match sequence shape {src.shape}")
 
-        out = self.transformer(src, src_mask, src_key_padding_mask=pad_mask)
+        # boolean mask (True = attend) broadcast over heads by SDPA: (B, 1, T, T) when
+        # causal, only (B, 1, 1, T) key padding otherwise
+        attn_mask = ~pad_mask[:, None, :]
+        if self.causal:
+            attn_mask = self.make_src_mask(times, nb_ctx_token) & attn_mask
+        attn_mask = attn_mask.unsqueeze(1)
+
+        out = self.transformer(src, attn_mask)
         encoder_out = out[:, :-nb_ctx_token]
         return self.dropout_out(encoder_out)
 
-    def make_src_mask(
-        self, times: torch.Tensor, nb_ctx_token: int, causal=True
+    def embed_input(
+        self, src: torch.Tensor, times: torch.Tensor, spaces: torch.Tensor
     ) -> torch.Tensor:
-        # TODO update if casusal is False
-        cond = times[:, :, None] >= times[:, None, :]
-        src_mask = torch.where(cond, 0.0, float("-inf"))
-
-        # deal with context tokens
-        src_mask = F.pad(src_mask, (0, 0, 0, nb_ctx_token), value=float("-inf"))
-        src_mask = F.pad(src_mask, (0, nb_ctx_token), value=0)
-
-        # TODO check if this is needed
-        # expand along heads
-        if src_mask.ndim == 3:
-            src_mask = repeat(src_mask, "b t1 t2 -> (b h) t1 t2", h=self.heads)
+        # dropout, the two embedding gathers and the adds form one pointwise region,
+        # which is fused when the model is compiled
+        return self.positional_encoding(times, spaces, src=self.dropout_in(src))
+
+    @torch.no_grad()
+    def make_src_mask(self, times: torch.Tensor, nb_ctx_token: int) -> torch.Tensor:
+        """Block-causal mask of shape (1, T + nb_ctx_token, T + nb_ctx_token).
+
+        The patch grid is fixed, so `times` is identical across samples and steps for
+        a given length. The mask is built from the first sample once and cached.
+        """
+        key = (times.shape[1], times.device, nb_ctx_token)
+        if key not in self._causal_mask_cache:
+            self._causal_mask_cache[key] = self._make_src_mask(times[:1], nb_ctx_token)
+        return self._causal_mask_cache[key]
+
+    @staticmethod
+    def _make_src_mask(times: torch.Tensor, nb_ctx_token: int) -> torch.Tensor:
+        b, t = times.shape
+        src_mask = torch.empty(
+            b, t + nb_ctx_token, t + nb_ctx_token, dtype=torch.bool, device=times.device
+        )
+        torch.ge(times[:, :, None], times[:, None, :], out=src_mask[:, :t, :t])
+
+        # deal with context tokens: they attend only to each other, and every token
+        # can attend to them
+        src_mask[:, t:, :t] = False
+        src_mask[:, :, t:] = True
         return src_mask
 
+    @torch.no_grad()
     def get_temporal_padding_mask(
         self, ref: torch.Tensor, batch: Dict[str, torch.Tensor]
     ) -> torch.Tensor:
@@ -354,10 +523,10 @@ class Transformer(nn.Module):
             # Don't truncate to encoder_frac since we need mask for full sequence
             # token_position = token_position[: batch["encoder_frac"]]
         else:
-            token_position = torch.arange(ref.shape[1], device=ref.device)
+            token_position = self._ar[: ref.shape[1]]
         
-        token_position = rearrange(token_position, "t -> () t")
-        token_length = batch["spike_tokens_mask"].sum(1, keepdim=True)
+        token_position = token_position.unsqueeze(0)
+        token_length = batch["_token_length"]
         
         # Ensure token_position matches the source sequence length
         if token_position.shape[1] < ref.shape[1]:
@@ -432,11 +601,20 @@ class SslDecoder(Decoder):
         causal=True,
         activation="gelu",
         pre_norm=False,
+        masked_loss_only=False,
     ):
+        """
+        Args:
+            masked_loss_only (Bool): If True, gather the masked tokens before the
+                readout and compute the loss on them only. Fewer FLOPs, but the
+                gather has a data-dependent shape (host sync, not torch.compile
+                friendly). Otherwise a static-shape masked mean is used.
+        """
         super().__init__()
 
         self.dim = dim
         self.neurons_per_token = patch_size[0]
+        self.masked_loss_only = masked_loss_only
 
         self.decoder = Transformer(
             dim=dim,
@@ -469,8 +647,9 @@ class SslDecoder(Decoder):
         # decoder_mask_tokens = repeat(self.mask_token, "h -> b t h", b=b, t=t)
         # decoder_input = torch.cat([encoder_output, decoder_mask_tokens], dim=1)
         target_masks = batch["spike_tokens_target_mask"]
-        decoder_input = encoder_output.clone()
-        decoder_input[target_masks] = self.mask_token
+        decoder_input = torch.where(
+            target_masks.unsqueeze(-1), self.mask_token, encoder_output
+        )
 
         # get time, space, and context
         # time = torch.cat([batch["time_idx"], batch["time_idx_target"]], 1)
@@ -479,8 +658,8 @@ class SslDecoder(Decoder):
         space = batch["space_idx"]
 
         # get temporal padding mask  TODO: check if this needs to be updated
-        token_position = rearrange(batch["shuffle"], "t -> () t")
-        token_length = batch["spike_tokens_mask"].sum(1, keepdim=True)
+        token_position = batch["shuffle"].unsqueeze(0)
+        token_length = batch["_token_length"]
         pad_mask = token_position >= token_length
 
         # decoder forward
@@ -489,40 +668,41 @@ class SslDecoder(Decoder):
 
         # target = batch["spike_tokens_target"].squeeze(-1)
 
+        if self.masked_loss_only:
+            # Isolate targets first, then compute rates and loss on them only. The
+            # output shape is data-dependent, so this path syncs with the host.
+            rates = self.out(decoder_out[target_masks])
+            target = batch["spike_tokens_target"][target_masks].reshape(rates.shape)
+            return {"loss": self.loss(rates, target).mean()}
+
         # compute rates
         # decoder_out = decoder_out[:, -target.size(1) :]   #needs to be compatible with other masking modes
         rates = self.out(decoder_out)
 
         # compute loss
         #get only the rates and target data corresponding to the target mask
-        target = batch["spike_tokens_target"].squeeze() # (B, T, space_patch_size, time_patch_size)
+        # (B, T, space_patch_size, time_patch_size) -> (B, T, neurons_per_token)
+        target = batch["spike_tokens_target"].reshape(rates.shape)
         loss: torch.Tensor = self.loss(rates, target)  # NOTE: Calculate across all patches then isolate targets
-        print(f'Ratio target masks: {target_masks.sum()} / {target_masks.numel()}')
-        while target_masks.ndim < loss.ndim:
-            target_masks = target_masks.unsqueeze(-1)
-        target_masks = target_masks.expand_as(loss)
-        loss = loss[target_masks]
-
-        #Isolate targets first, then compute loss
-        # masked_rates = rates[target_masks].contiguous()
-        # masked_targets = target[target_masks].contiguous()
-        # loss = self.loss(masked_rates, masked_targets)
+        # static-shape masked mean, the (B, T, 1) mask is broadcast over the neurons
+        target_masks = target_masks.unsqueeze(-1).to(loss.dtype)
+        num_targets = target_masks.sum() * loss.shape[-1]
+        loss = (loss * target_masks).sum() / num_targets.clamp_min(1)
+
         # loss_mask = self.get_loss_mask(batch, loss)  # NOTE: ORIGINAL CODE
         # loss = loss[loss_mask]                       # NOTE: ORIGINAL CODE
 
-        return {"loss": loss.mean()}
+        return {"loss": loss}
 
     def get_loss_mask(self, batch: Dict[str, torch.Tensor], loss: torch.Tensor):
         loss_mask = torch.ones(loss.size(), device=loss.device, dtype=torch.bool)
 
         tmp = torch.arange(loss.shape[-1], device=loss.device)
-        comparison = repeat(tmp, "c -> 1 t c", t=loss.shape[1])
-        channel_mask = comparison < batch["channel_counts_target"].unsqueeze(-1)
+        channel_mask = tmp < batch["channel_counts"].unsqueeze(-1)
         loss_mask = loss_mask & channel_mask
 
-        token_position = batch["shuffle"][batch["encoder_frac"] :]
-        token_position = rearrange(token_position, "t -> () t")
-        token_length = batch["spike_tokens_mask"].sum(1, keepdim=True)
+        token_position = batch["shuffle"][batch["encoder_frac"] :].unsqueeze(0)
+        token_length = batch["_token_length"]
         length_mask = token_position < token_length
 
         return loss_mask & length_mask.unsqueeze(-1)
@@ -558,6 +738,9 @@ class BhvrDecoder(Decoder):
         self.behavior_lag_lookahead = behavior_lag_lookahead
 
         self.query_token = nn.Parameter(torch.randn(dim))
+        self.register_buffer(
+            "_ar", torch.arange(max_time_patches * max_space_patches), persistent=False
+        )
         self.decoder = Transformer(
             dim=dim,
             depth=depth,
@@ -582,7 +765,7 @@ class BhvrDecoder(Decoder):
         # prepare decoder input and temporal padding mask
         bhvr_tgt = batch["bhvr_vel"]
         time = batch["time_idx"]
-        token_length = batch["spike_tokens_mask"].sum(1, keepdim=True)
+        token_length = batch["_token_length"]
         pad_mask = self.temporal_pad_mask(encoder_out, token_length)
         encoder_out, pad_mask = self.temporal_pool(time, encoder_out, pad_mask)
         decoder_in, pad_mask = self.prepare_decoder_input(
@@ -606,14 +789,14 @@ class BhvrDecoder(Decoder):
         length_mask = self.get_length_mask(decoder_out, bhvr_tgt, token_length)
         loss = self.loss(bhvr, bhvr_tgt, length_mask)
         r2 = self.r2(bhvr, bhvr_tgt, length_mask)
-        return {"loss": loss, "r2": r2}
+        return {"loss": loss, "r2": r2, "r2_mean": r2.mean()}
 
+    @torch.no_grad()
     def temporal_pad_mask(
         self, ref: torch.Tensor, max_lenght: torch.Tensor
     ) -> torch.Tensor:
-        token_position = torch.arange(ref.shape[1], device=ref.device)
-        token_position = rearrange(token_position, "t -> () t")
-        return token_position >= rearrange(max_lenght, "b -> b ()")
+        token_position = self._ar[: ref.shape[1]]
+        return token_position.unsqueeze(0) >= max_lenght.view(-1, 1)
 
     def temporal_pool(
         self,
@@ -622,30 +805,35 @@ class BhvrDecoder(Decoder):
         pad_mask: torch.Tensor,
     ) -> Tuple[torch.Tensor, torch.Tensor]:
         b, nb_tokens, h = encoder_out.shape
-        b = encoder_out.shape[0]
-        t = times.max() + 1
-        h = encoder_out.shape[-1]
+        t = int(times.max()) + 1
         dev = encoder_out.device
         pool = self.decode_time_pool
 
         # t + 1 for padding
-        pooled_features = torch.zeros(b, t + 1, h, device=dev, dtype=encoder_out.dtype)
-
-        time_with_pad_marked = torch.where(pad_mask, t, times)
-        index = repeat(time_with_pad_marked, "b t -> b t h", h=h).to(torch.long)
-        pooled_features = pooled_features.scatter_reduce(
-            src=encoder_out, dim=1, index=index, reduce=pool, include_self=False
-        )
+        time_with_pad_marked = torch.where(pad_mask, t, times).long()
+        if segment_coo is not None and pool in SEGMENT_COO_REDUCE:
+            # patches are time-major and padding is on the right, so the index is
+            # sorted along each row and the atomics-free segment reduction applies
+            pooled_features = segment_coo(
+                encoder_out,
+                time_with_pad_marked,
+                dim_size=t + 1,
+                reduce=SEGMENT_COO_REDUCE[pool],
+            )
+        else:
+            pooled_features = torch.zeros(
+                b, t + 1, h, device=dev, dtype=encoder_out.dtype
+            )
+            index = time_with_pad_marked.unsqueeze(-1).expand(-1, -1, h)
+            pooled_features = pooled_features.scatter_reduce(
+                src=encoder_out, dim=1, index=index, reduce=pool, include_self=False
+            )
         encoder_out = pooled_features[:, :-1]  # remove padding
 
-        nb_tokens = encoder_out.shape[1]
-        new_pad_mask = torch.ones(b, nb_tokens, dtype=bool, device=dev).float()
-        src = torch.zeros_like(times).float()
-
-        times = times.to(torch.long)
-        new_pad_mask = new_pad_mask.scatter_reduce(
-            src=src, dim=1, index=times, reduce="prod", include_self=False
-        ).bool()
+        # a pooled slot is padding if no token was scattered into it
+        hit = torch.zeros(b, t, dtype=torch.bool, device=dev)
+        hit.scatter_(1, times.long(), True)
+        new_pad_mask = ~hit
 
         return encoder_out, new_pad_mask
 
@@ -657,7 +845,7 @@ class BhvrDecoder(Decoder):
         max_length: torch.Tensor,
     ) -> Tuple[torch.Tensor, torch.Tensor]:
         b, t = bhvr_vel.size()[:2]
-        query_tokens = repeat(self.query_token, "h -> b t h", b=b, t=t)
+        query_tokens = self.query_token.expand(b, t, -1)
         if encoder_out.shape[1] < t:
             to_add = t - encoder_out.shape[1]
             encoder_out = F.pad(encoder_out, (0, 0, 0, to_add), value=0)
@@ -671,6 +859,7 @@ class BhvrDecoder(Decoder):
 
         return decoder_in, pad_mask
 
+    @torch.no_grad()
     def get_time_space(
         self,
         bhvr_vel: torch.Tensor,
@@ -678,7 +867,7 @@ class BhvrDecoder(Decoder):
         b, t = bhvr_vel.size()[:2]
         dev = bhvr_vel.device
 
-        time = repeat(torch.arange(t, device=dev), "t -> b t", b=b)
+        time = self._ar[:t].expand(b, -1)
         query_time = time
         if self.causal and self.behavior_lag_lookahead:
             # allow looking N-bins of neural data into the "future";
@@ -722,16 +911,24 @@ class BhvrDecoder(Decoder):
 
     def r2(
         self, bhvr: torch.Tensor, bhvr_tgt: torch.Tensor, length_mask: torch.Tensor
-    ) -> np.ndarray:
-        tgt = bhvr_tgt[length_mask].float().detach().cpu()
-        bhvr = bhvr[length_mask].float().detach().cpu()
+    ) -> torch.Tensor:
+        """Per-output r2 over the valid (B, T) positions, as sklearn.metrics.r2_score
+        (and torchmetrics' `R2Score(multioutput="raw_values")`) on the masked rows.
+
+        Computed on device with a masked reduction instead of boolean indexing, so
+        the host is never synced.
+        """
+        mask = length_mask.unsqueeze(-1)
+        tgt = torch.where(mask, bhvr_tgt.detach().float(), 0.0)
+        bhvr = torch.where(mask, bhvr.detach().float(), 0.0)
+
+        num_obs = mask.sum((0, 1))
+        tgt_mean = tgt.sum((0, 1)) / num_obs
+        ss_tot = torch.where(mask, tgt - tgt_mean, 0.0).pow(2).sum((0, 1))
+        ss_res = (bhvr - tgt).pow(2).sum((0, 1))
+        r2 = 1 - ss_res / ss_tot
 
-        # o.g. r2 is computed with sklearn.metrics.r2_score
-        r2_score = R2Score(multioutput="raw_values")
-        r2 = r2_score(bhvr, tgt)
-        if r2.mean() < -10:
-            r2 = np.zeros_like(r2)
-        return r2
+        return torch.where(r2.mean() < -10, torch.zeros_like(r2), r2)
 
 
 class NDT2Model(nn.Module):
@@ -753,6 +950,8 @@ class NDT2Model(nn.Module):
     def forward(self, batch, method: str = "ssl"):
         if method == "ssl":
             batch = self.mae_mask_manager(batch)
+        # number of valid tokens per sample, shared by the encoder and decoders
+        batch["_token_length"] = batch["spike_tokens_mask"].sum(1, keepdim=True)
         encoder_input = self.spikes_patchifier(batch["spike_tokens"])
         ctx_emb = self.ctx_manager(batch, encoder_input.dtype)
         encoder_out = self.encoder(encoder_input, ctx_emb, batch)
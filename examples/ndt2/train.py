@@ -1,11 +1,14 @@
+import hashlib
 import logging
+import os
+import pickle
 from collections import defaultdict
+from pathlib import Path
 from typing import Dict, List, Optional, Tuple
 
 import hydra
 import lightning as L
 import numpy as np
-import pandas as pd
 import torch
 from lightning.pytorch.callbacks import (
     Callback,
@@ -15,6 +18,7 @@ from lightning.pytorch.callbacks import (
     ModelSummary,
 )
 from lightning.pytorch.loggers import WandbLogger
+from lightning.pytorch.strategies import DDPStrategy
 from model import (
     BhvrDecoder,
     ContextManager,
@@ -36,9 +40,16 @@ from torch_brain.data.sampler import (
     SequentialFixedWindowSampler,
 )
 from torch_brain.transforms import Compose
+from torch_brain.utils import resolve_precision
 
 log = logging.getLogger(__name__)
 
+# torch.load(..., mmap=True) requires torch >= 2.1, older versions reject the kwarg
+TORCH_SUPPORTS_MMAP = tuple(map(int, torch.__version__.split(".")[:2])) >= (2, 1)
+
+# bump when the output of ndt2_custom_sampling_intervals changes
+INTERVAL_CACHE_VERSION = 2
+
 import torch.nn as nn
 
 
@@ -49,6 +60,16 @@ class TrainWrapper(L.LightningModule):
         self.cfg = cfg
         self.is_ssl = cfg.is_ssl
 
+        if cfg.get("compile", False):
+            compile_kwargs = dict(mode=cfg.get("compile_mode", "default"))
+            # compile in place so state dict keys (and checkpoints) are unchanged,
+            # nn.Module.compile only exists from torch 2.2, before that the forward
+            # is compiled on the instance, which also leaves the state dict untouched
+            if hasattr(self.model, "compile"):
+                self.model.compile(**compile_kwargs)
+            else:
+                self.model.forward = torch.compile(self.model.forward, **compile_kwargs)
+
     def training_step(self, batch, batch_idx):
         ssl_loss = 0.0
         superv_loss = 0.0
@@ -61,7 +82,12 @@ class TrainWrapper(L.LightningModule):
             decoder_out = self.model(batch, "bhv")
             superv_loss = decoder_out["loss"]
             self.log("train_kinematic_decoding_loss", decoder_out["loss"])
-            self.log("train_kinematic_r2", decoder_out["r2"].mean())
+            self.log(
+                "train_kinematic_r2",
+                decoder_out["r2_mean"],
+                on_step=False,
+                on_epoch=True,
+            )
 
         loss = ssl_loss + superv_loss
         self.log("train_loss", loss, prog_bar=True)
@@ -95,7 +121,7 @@ class TrainWrapper(L.LightningModule):
             )
             self.log(
                 f"{prefix}kinematic_r2",
-                decoder_out["r2"].mean(),
+                decoder_out["r2_mean"],
                 add_dataloader_idx=False,
             )
 
@@ -112,10 +138,13 @@ class TrainWrapper(L.LightningModule):
 
     def split_params(self, params):
         cfg = self.cfg.optimizer
-        accel_flag = lambda n: "decoder" in n or "ctx_manager" in n and "_emb" in n
 
-        accelerate_params = [p for n, p in params if accel_flag(n)]
-        regular_params = [p for n, p in params if not accel_flag(n)]
+        accelerate_params, regular_params = [], []
+        for n, p in params:
+            if ("decoder" in n) or ("ctx_manager" in n and "_emb" in n):
+                accelerate_params.append(p)
+            else:
+                regular_params.append(p)
         return [
             {
                 "params": accelerate_params,
@@ -134,7 +163,15 @@ class TrainWrapper(L.LightningModule):
         if cfg.get("accelerate_factor", 1) > 1:
             params = self.split_params(self.named_parameters())
 
-        optimizer = torch.optim.AdamW(params, lr=cfg.lr, weight_decay=cfg.weight_decay)
+        # single fused kernel on GPU, multi-tensor (foreach) implementation otherwise
+        fused = self.device.type == "cuda"
+        optimizer = torch.optim.AdamW(
+            params,
+            lr=cfg.lr,
+            weight_decay=cfg.weight_decay,
+            fused=fused,
+            foreach=not fused,
+        )
 
         if not cfg.scheduler:
             return {"optimizer": optimizer}
@@ -145,11 +182,16 @@ class TrainWrapper(L.LightningModule):
         cosineAnnealingLR = optim.lr_scheduler.CosineAnnealingLR(
             optimizer, T_max=cfg.decay_steps, eta_min=cfg.lr_min
         )
-        scheduler = optim.lr_scheduler.ChainedScheduler([linearLR, cosineAnnealingLR])
+        # warmup, then cosine decay, a single scheduler is active at each step
+        scheduler = optim.lr_scheduler.SequentialLR(
+            optimizer,
+            schedulers=[linearLR, cosineAnnealingLR],
+            milestones=[cfg.warmup_steps],
+        )
 
         return {
             "optimizer": optimizer,
-            "lr_scheduler": {"scheduler": scheduler},
+            "lr_scheduler": {"scheduler": scheduler, "interval": "step"},
         }
 
     def on_save_checkpoint(self, ckpt):
@@ -190,12 +232,24 @@ class DataModule(L.LightningDataModule):
         self.train_intervals: Dict[str, List[Tuple[float, float]]]
         self.val_intervals: Dict[str, List[Tuple[float, float]]]
         self.eval_intervals: Optional[Dict[str, List[Tuple[float, float]]]]
-        intervals = self.ndt2_custom_sampling_intervals()
+        intervals = self.cached_sampling_intervals()
         self.train_intervals, self.val_intervals, self.eval_intervals = intervals
 
     def get_ctx_vocab(self, ctx_keys):
         return {k: getattr(self.dataset, f"get_{k}_ids")() for k in ctx_keys}
 
+    def loader_kwargs(self) -> Dict:
+        cfg = self.cfg
+        kwargs = dict(
+            collate_fn=collate,
+            num_workers=cfg.num_workers,
+            pin_memory=cfg.get("pin_memory", True),
+        )
+        if cfg.num_workers > 0:
+            kwargs["persistent_workers"] = True
+            kwargs["prefetch_factor"] = cfg.get("prefetch_factor", 2)
+        return kwargs
+
     def train_dataloader(self):
         cfg = self.cfg
         train_sampler = RandomFixedWindowSampler(
@@ -208,8 +262,7 @@ class DataModule(L.LightningDataModule):
             dataset=self.dataset,
             batch_size=bs,
             sampler=train_sampler,
-            collate_fn=collate,
-            num_workers=cfg.num_workers,
+            **self.loader_kwargs(),
         )
 
         return train_loader
@@ -228,8 +281,7 @@ class DataModule(L.LightningDataModule):
             dataset=self.dataset,
             batch_size=bs,
             sampler=val_sampler,
-            collate_fn=collate,
-            num_workers=cfg.num_workers,
+            **self.loader_kwargs(),
         )
         if self.eval_intervals is None:
             return val_loader
@@ -243,8 +295,7 @@ class DataModule(L.LightningDataModule):
             dataset=self.dataset,
             batch_size=bs,
             sampler=eval_sampler,
-            collate_fn=collate,
-            num_workers=cfg.num_workers,
+            **self.loader_kwargs(),
         )
 
         return [val_loader, eval_loader]
@@ -254,37 +305,93 @@ class DataModule(L.LightningDataModule):
 
     # The next function are utils for ndt2_custom_sampling_intervals
     def sort_sessions(self, res):
-        ind = np.argsort([int(e.split("-")[1]) for e in res])
-        return [res[i] for i in ind]
+        # keys are "{session_id}-{trial}", session ids may contain "-" themselves
+        trials = np.fromiter(
+            (int(e.rsplit("-", 1)[1]) for e in res), dtype=np.int64, count=len(res)
+        )
+        return [res[i] for i in np.argsort(trials)]
 
     def ndt2_eval_split(self, ses_keys):
         cfg = self.cfg
         nb_sessions = len(ses_keys)
-        df = pd.DataFrame([0] * nb_sessions)
-        eval_subset = df.sample(frac=cfg.eval_ratio, random_state=cfg.eval_seed)
-        eval_keys = [ses_keys[i] for i in eval_subset.index]
-        non_eval_keys = [ses_keys[i] for i in df.index.difference(eval_subset.index)]
+        rng = np.random.default_rng(cfg.eval_seed)
+        eval_idx = rng.choice(
+            nb_sessions, size=round(cfg.eval_ratio * nb_sessions), replace=False
+        )
+        non_eval_mask = np.ones(nb_sessions, dtype=bool)
+        non_eval_mask[eval_idx] = False
+        eval_keys = [ses_keys[i] for i in eval_idx]
+        non_eval_keys = [ses_keys[i] for i in np.flatnonzero(non_eval_mask)]
         return self.sort_sessions(eval_keys), self.sort_sessions(non_eval_keys)
 
     def ndt2_limit_per_session(self, ses_keys):
         cfg = self.cfg
         nb_sessions = len(ses_keys)
-        df = pd.DataFrame([0] * nb_sessions)
-        subset = df.sample(cfg.limit_per_eval_session)
-        ses_keys = [ses_keys[i] for i in subset.index]
+        rng = np.random.default_rng(cfg.split_seed)
+        subset = rng.choice(nb_sessions, size=cfg.limit_per_eval_session, replace=False)
+        ses_keys = [ses_keys[i] for i in subset]
         return self.sort_sessions(ses_keys)
 
     def check_data_overlap(self, train_keys, val_keys):
-        train_set = set(train_keys)
-        val_set = set(val_keys)
-        overlap = train_set.intersection(val_set)
-        print("\n=== Data Overlap Check ===")
-        print(f"Number of overlapping keys: {len(overlap)}")
+        overlap = np.intersect1d(train_keys, val_keys)
+        log.debug(f"Number of overlapping train/val keys: {len(overlap)}")
         if len(overlap) > 0:
-            print("First 5 overlapping keys:", list(overlap)[:5])
-        print("======================\n")
+            log.debug(f"First 5 overlapping keys: {overlap[:5].tolist()}")
         return len(overlap)
 
+    def cached_sampling_intervals(self) -> Tuple[Dict, Dict, Optional[Dict]]:
+        """
+        Returns the output of ndt2_custom_sampling_intervals, cached on disk under
+        `log_dir/.interval_cache`, keyed by a hash of every config entry the split
+        depends on and of the recordings found under `data_root`, with their
+        modification times. Set `cache_intervals: false` to always recompute.
+        """
+        cfg = self.cfg
+        if not cfg.get("cache_intervals", True):
+            return self.ndt2_custom_sampling_intervals()
+
+        # adding, removing or re-processing a recording changes the split
+        recordings = {
+            recording_id: os.stat(info["filename"]).st_mtime_ns
+            for recording_id, info in sorted(self.dataset.recording_dict.items())
+        }
+        split_cfg = OmegaConf.create(
+            {
+                "version": INTERVAL_CACHE_VERSION,
+                "recordings": recordings,
+                "data_root": cfg.data_root,
+                "dataset": self.dataset_cfg,
+                "ctx_time": cfg.ctx_time,
+                "train_ratio": cfg.train_ratio,
+                "split_seed": cfg.split_seed,
+                "is_eval": cfg.get("is_eval", False),
+                "eval_ratio": cfg.get("eval_ratio", None),
+                "eval_seed": cfg.get("eval_seed", None),
+                "limit_per_eval_session": cfg.get("limit_per_eval_session", None),
+            }
+        )
+        digest = hashlib.blake2b(
+            OmegaConf.to_yaml(split_cfg).encode(), digest_size=16
+        ).hexdigest()
+        cache_path = Path(cfg.log_dir) / ".interval_cache" / f"{digest}.pkl"
+
+        if cache_path.exists():
+            log.info(f"Loading sampling intervals from {cache_path}")
+            with open(cache_path, "rb") as f:
+                return pickle.load(f)
+
+        intervals = self.ndt2_custom_sampling_intervals()
+
+        # write then rename, several ranks may populate the cache concurrently
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = cache_path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, "wb") as f:
+            pickle.dump(intervals, f)
+        os.replace(tmp_path, cache_path)
+        log.info(f"Cached sampling intervals to {cache_path}")
+
+        return intervals
+
     def ndt2_custom_sampling_intervals(self) -> Tuple[Dict, Dict]:
         """
         Custom sampling intervals for NDT2.
@@ -298,90 +405,65 @@ class DataModule(L.LightningDataModule):
         train_ratio = self.cfg.train_ratio
         seed = self.cfg.split_seed
 
-        print("\n=== Session Debug ===")
-        print("Available sessions:", list(dataset._data_objects.keys()))
-        
         for ses_id, ses in dataset._data_objects.items():
             nb_trials = int(ses.domain.end[-1] - ses.domain.start[0])
-            print(f"\nProcessing session: {ses_id}")
-            print(f"Number of trials: {nb_trials}")
-            print(f"Session start: {ses.domain.start[0]}")
-            print(f"Session end: {ses.domain.end[-1]}")
-            
-            for i in range(nb_trials):
-                trial_key = f"{ses_id}-{i}"
-                ses_keys.append(trial_key)
-                print(f"Added trial key: {trial_key}")
+            log.debug(
+                f"Session {ses_id}: {nb_trials} trials "
+                f"({ses.domain.start[0]} - {ses.domain.end[-1]})"
+            )
+            ses_keys.extend(f"{ses_id}-{i}" for i in range(nb_trials))
 
         if self.cfg.get("is_eval", False):
             ses_keys = self.sort_sessions(ses_keys)
             eval_keys, ses_keys = self.ndt2_eval_split(ses_keys)
             ses_keys = self.ndt2_limit_per_session(ses_keys)
 
-        print("\n=== Data Split Debug ===")
-        print(f"Total number of trials: {len(ses_keys)}")
-        print(f"Split seed: {seed}")
-        print(f"Train ratio: {train_ratio}")
-        print(f"All trial keys: {ses_keys}")
-        
-        # Store original order
-        original_keys = ses_keys.copy()
-        
-        L.seed_everything(seed)
-        np.random.shuffle(ses_keys)
+        log.debug(
+            f"Splitting {len(ses_keys)} trials (split seed: {seed}, "
+            f"train ratio: {train_ratio})"
+        )
+
+        # local generator, the global RNGs are seeded once in run_training
+        rng = np.random.default_rng(seed)
+        rng.shuffle(ses_keys)
         tv_cut = int(train_ratio * len(ses_keys))
         train_keys, val_keys = ses_keys[:tv_cut], ses_keys[tv_cut:]
-        
-        print(f"\nNumber of training trials: {len(train_keys)}")
-        print(f"Number of validation trials: {len(val_keys)}")
-        print(f"All training keys: {train_keys}")
-        print(f"All validation keys: {val_keys}")
-        
+        log.debug(
+            f"Number of training/validation trials: {len(train_keys)}/{len(val_keys)}"
+        )
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(f"All training keys: {train_keys}")
+            log.debug(f"All validation keys: {val_keys}")
+
         # Check for overlap
         overlap_count = self.check_data_overlap(train_keys, val_keys)
         if overlap_count > 0:
-            print("WARNING: Found overlap between train and validation sets!")
-        
-        print("======================\n")
+            log.warning("Found overlap between train and validation sets!")
 
-        def get_dict(keys):
-            d = defaultdict(list)
+        def get_dict(keys, sort=False):
+            trials = defaultdict(list)
             for k in keys:
-                # ses_id, trial = k.split("-")
-                trial = k.split("-")[-1]
-                ses_id = "-".join(k.split("-")[:-1])
-                ses = dataset._data_objects[ses_id]
-                ses_start = ses.domain.start[0]
-                offset = ctx_time * int(trial)
-                start = ses_start + offset
-                end = start + ctx_time
-                d[ses_id].append((start, end))
-            return dict(d)
+                ses_id, _, trial = k.rpartition("-")
+                trials[ses_id].append(int(trial))
+
+            d = {}
+            for ses_id, trial_idx in trials.items():
+                trial_idx = np.asarray(trial_idx, dtype=np.int64)
+                if sort:
+                    # sorted, and no window is sampled twice
+                    trial_idx = np.unique(trial_idx)
+                ses_start = dataset._data_objects[ses_id].domain.start[0]
+                start = ses_start + ctx_time * trial_idx
+                d[ses_id] = Interval(start, start + ctx_time)
+            return d
 
         train_sampling_intervals = get_dict(train_keys)
-        val_sampling_intervals = get_dict(val_keys)
-
         # val will be deterministic and need to be sorted
-        for v in val_sampling_intervals.values():
-            v.sort()
-        val_sampling_intervals = dict(sorted(val_sampling_intervals.items()))
-
-        # TODO this is very dirty code should be cleaned
-        def list_to_inter(l):
-            start = np.array([e[0] for e in l])
-            end = np.array([e[1] for e in l])
-            return Interval(start, end)
-
-        def to_inter(d):
-            return {k: list_to_inter(v) for k, v in d.items()}
-
-        train_sampling_intervals = to_inter(train_sampling_intervals)
-        val_sampling_intervals = to_inter(val_sampling_intervals)
+        val_sampling_intervals = dict(sorted(get_dict(val_keys, sort=True).items()))
 
         eval_sampling_intervals = None
         if self.cfg.get("is_eval", False):
             eval_sampling_intervals = get_dict(eval_keys)
-            eval_sampling_intervals = to_inter(eval_sampling_intervals)
 
         return train_sampling_intervals, val_sampling_intervals, eval_sampling_intervals
 
@@ -435,10 +517,16 @@ def run_training(cfg):
 
     with open_dict(cfg):
         # Adjust batch size for multi-gpu
-        num_gpus = torch.cuda.device_count()
-        # num_gpus += 1 #NOTE: CHANGED FOR DEBUGGING ON CPU   
-        cfg.batch_size_per_gpu = cfg.batch_size // num_gpus
+        # a CPU-only run counts as a single device
+        num_gpus = max(1, torch.cuda.device_count())
         cfg.superv_batch_size = cfg.superv_batch_size or cfg.batch_size
+        for key in ("batch_size", "superv_batch_size"):
+            if cfg[key] % num_gpus != 0:
+                raise ValueError(
+                    f"{key} ({cfg[key]}) must be divisible by the number of GPUs "
+                    f"({num_gpus})"
+                )
+        cfg.batch_size_per_gpu = cfg.batch_size // num_gpus
         cfg.superv_batch_size_per_gpu = cfg.superv_batch_size // num_gpus
         log.info(f"Number of GPUs: {num_gpus}")
         log.info(f"Batch size per GPU: {cfg.batch_size_per_gpu}")
@@ -450,7 +538,12 @@ def run_training(cfg):
     # Mask manager (for MAE SSL)
     mae_mask_manager = None
     if cfg.is_ssl:
-        mae_mask_manager = MaeMaskManager(cfg.mask_ratio)
+        num_bins = round(cfg.ctx_time / cfg.bin_time)
+        mae_mask_manager = MaeMaskManager(
+            cfg.mask_ratio,
+            num_temporal_patches=num_bins // cfg.patch_size[1],
+            num_spatial_patches=cfg.get("num_spatial_patches", None),
+        )
 
     # Context manager
     ctx_manager = ContextManager(dim)
@@ -510,7 +603,13 @@ def run_training(cfg):
 
     # Load from checkpoint
     if cfg.get("load_from_checkpoint", False):
-        ckpt = torch.load(cfg.checkpoint_path)
+        # memory-map the tensors when supported; this is a full Lightning checkpoint
+        # whose LR scheduler state pickles a bound method on torch < 2.3, so it
+        # cannot go through the weights-only unpickler
+        load_kwargs = {"mmap": True} if TORCH_SUPPORTS_MMAP else {}
+        ckpt = torch.load(
+            cfg.checkpoint_path, map_location="cpu", weights_only=False, **load_kwargs
+        )
         model.ctx_manager.load_state_dict(ckpt["context_manager_state_dict"])
         model.spikes_patchifier.load_state_dict(ckpt["spikes_patchifier_state_dict"])
         model.encoder.load_state_dict(ckpt["encoder_state_dict"])
@@ -535,13 +634,21 @@ def run_training(cfg):
         default_root_dir=cfg.log_dir,
         check_val_every_n_epoch=cfg.eval_epochs,
         max_epochs=cfg.epochs,
+        # Lightning skips the DDP gradient all-reduce on non-final micro-batches
+        accumulate_grad_batches=cfg.get("accumulate_grad_batches", 1),
         log_every_n_steps=cfg.log_every_n_steps,
         callbacks=callbacks,
         accelerator="gpu",
-        precision=cfg.precision,
+        precision=resolve_precision(cfg.get("precision", None)),
         fast_dev_run=cfg.fast_dev_run,
         num_sanity_val_steps=cfg.num_sanity_val_steps,
-        strategy="ddp_find_unused_parameters_true",
+        # the set of used parameters is fixed for a given run (ssl or bhv), so DDP can
+        # reuse its buckets and skip the per-step search for unused parameters
+        strategy=DDPStrategy(
+            find_unused_parameters=cfg.get("find_unused_parameters", False),
+            static_graph=True,
+            gradient_as_bucket_view=True,
+        ),
     )
 
     if wandb_logger:
@@ -557,41 +664,27 @@ def run_training(cfg):
 
 @hydra.main(version_base="1.3", config_path="./configs", config_name="train_ssl.yaml")
 def main(cfg):
-    # First, load dataset config without session filter to see available sessions
-    cfg['dataset'] = [{
-        'selection': [{
-            'brainset': 'perich_miller_population_2018'
-        }]
-    }]
-    
-    # Create temporary dataset to check available sessions
-    from torch_brain.data import Dataset
-    temp_dataset = Dataset(
-        root=cfg.data_root,
-        split=None,
-        config=cfg.dataset
-    )
-    
-    print("\n=== Available Sessions ===")
-    available_sessions = list(temp_dataset._data_objects.keys())
-    print("Sessions in dataset:", available_sessions)
-    if len(available_sessions) > 0:
-        # Extract just the session name without the dataset prefix
-        selected_session = available_sessions[0].split('/')[-1]  # Get everything after the last '/'
-        print(f"Using session: {selected_session}")
-        print("=========================\n")
-        
-        # Now set the actual configuration with the valid session
-        cfg['dataset'] = [{
-            'selection': [{
-                'brainset': 'perich_miller_population_2018',
-                'sessions': [selected_session]
-            }]
-        }]
-        
-        run_training(cfg)
-    else:
-        print("No sessions found in the dataset!")
+    # "high" uses TF32 tensor cores for fp32 matmuls on Ampere+ GPUs
+    torch.set_float32_matmul_precision(cfg.get("matmul_precision", "high"))
+
+    brainset = "perich_miller_population_2018"
+
+    # List the available sessions from the file names, without opening a Dataset,
+    # the Dataset is built once in DataModule.setup
+    brainset_dir = Path(cfg.data_root) / brainset
+    available_sessions = sorted(f.stem for f in brainset_dir.glob("*.h5"))
+    log.info(f"Sessions in dataset: {available_sessions}")
+    if len(available_sessions) == 0:
+        log.error(f"No sessions found in {brainset_dir}!")
+        return
+
+    selected_session = available_sessions[0]
+    log.info(f"Using session: {selected_session}")
+
+    cfg["dataset"] = [
+        {"selection": [{"brainset": brainset, "sessions": [selected_session]}]}
+    ]
+    run_training(cfg)
 
 
 if __name__ == "__main__":
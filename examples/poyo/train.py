@@ -13,13 +13,14 @@ from lightning.pytorch.callbacks import (
     ModelCheckpoint,
     ModelSummary,
 )
+from lightning.pytorch.strategies import DDPStrategy
 from omegaconf import DictConfig, OmegaConf
 from temporaldata import Data
 
 from torch_brain.registry import MODALITIY_REGISTRY, ModalitySpec
 from torch_brain.models.poyo import POYOTokenizer, poyo_mp
 from torch_brain.utils import callbacks as tbrain_callbacks
-from torch_brain.utils import seed_everything
+from torch_brain.utils import resolve_precision, seed_everything
 from torch_brain.utils.stitcher import DecodingStitchEvaluator
 from torch_brain.data import Dataset, collate
 from torch_brain.nn import compute_loss_or_metric
@@ -29,10 +30,6 @@ from torch_brain.data.sampler import (
 )
 from torch_brain.transforms import Compose
 
-# higher speed on machines with tensor cores
-torch.set_float32_matmul_precision("medium")
-
-
 logger = logging.getLogger(__name__)
 
 
@@ -50,15 +47,44 @@ class TrainWrapper(L.LightningModule):
         self.modality_spec = modality_spec
         self.save_hyperparameters(OmegaConf.to_container(cfg))
 
-    def configure_optimizers(self):
-        max_lr = self.cfg.optim.base_lr * self.cfg.batch_size  # linear scaling rule
+        if cfg.get("compile", False):
+            compile_kwargs = dict(mode=cfg.get("compile_mode", "default"))
+            if cfg.get("compile_dynamic", None) is not None:
+                compile_kwargs["dynamic"] = cfg.compile_dynamic
+            # compile in place so state dict keys (and checkpoints) are unchanged,
+            # nn.Module.compile only exists from torch 2.2, before that the forward
+            # is compiled on the instance, which also leaves the state dict untouched
+            if hasattr(self.model, "compile"):
+                self.model.compile(**compile_kwargs)
+            else:
+                self.model.forward = torch.compile(self.model.forward, **compile_kwargs)
 
-        optimizer = Lamb(
-            self.model.parameters(),
-            lr=max_lr,
-            weight_decay=self.cfg.optim.weight_decay,
+    def configure_optimizers(self):
+        # linear scaling rule, on the effective batch size
+        max_lr = (
+            self.cfg.optim.base_lr
+            * self.cfg.batch_size
+            * self.cfg.get("accumulate_grad_batches", 1)
         )
 
+        if self.cfg.optim.get("fused", False):
+            # multi-tensor CUDA kernels for the whole step, requires NVIDIA apex
+            from apex.optimizers import FusedLAMB
+
+            optimizer = FusedLAMB(
+                self.model.parameters(),
+                lr=max_lr,
+                weight_decay=self.cfg.optim.weight_decay,
+                # apex clips the global grad norm to 1.0 by default, Lamb does not
+                max_grad_norm=float("inf"),
+            )
+        else:
+            optimizer = Lamb(
+                self.model.parameters(),
+                lr=max_lr,
+                weight_decay=self.cfg.optim.weight_decay,
+            )
+
         scheduler = torch.optim.lr_scheduler.OneCycleLR(
             optimizer,
             max_lr=max_lr,
@@ -84,8 +110,8 @@ class TrainWrapper(L.LightningModule):
         # forward pass
         output_values = self.model(**batch)
 
-        # compute loss
-        output_values = output_values[output_mask]
+        # compute loss, reduced in fp32 even when the forward runs in bf16/fp16
+        output_values = output_values[output_mask].float()
         target_values = target_values[output_mask]
         target_weights = target_weights[output_mask]
 
@@ -109,27 +135,28 @@ class TrainWrapper(L.LightningModule):
         #     self.log(f"targets/mean_{name}", targets.mean())
         #     self.log(f"targets/std_{name}", targets.std())
 
-        unit_index = batch["input_unit_index"].float()
-        self.log("inputs/mean_unit_index", unit_index.mean())
-        self.log("inputs/std_unit_index", unit_index.std())
+        # input statistics are only for monitoring, skip the reductions on most steps
+        if self.global_step % self.cfg.get("log_inputs_every_n_steps", 100) == 0:
+            unit_index = batch["input_unit_index"].float()
+            self.log("inputs/mean_unit_index", unit_index.mean())
+            self.log("inputs/std_unit_index", unit_index.std())
 
         return loss
 
     def validation_step(self, batch, batch_idx):
-        target_values = batch.pop("target_values")
-        batch.pop("target_weights")
-        absolute_starts = batch.pop("absolute_start")
-        session_ids = batch.pop("session_id")
-        output_mask = batch.pop("output_mask")
+        # the stitch evaluator reads the targets and metadata from the batch, so leave
+        # it untouched and only pass the model inputs to the forward pass
+        non_model_keys = (
+            "target_values",
+            "target_weights",
+            "absolute_start",
+            "session_id",
+            "output_mask",
+        )
+        model_inputs = {k: v for k, v in batch.items() if k not in non_model_keys}
 
         # forward pass
-        output_values = self.model(**batch)
-
-        # add removed elements back to batch
-        batch["target_values"] = target_values
-        batch["absolute_start"] = absolute_starts
-        batch["session_id"] = session_ids
-        batch["output_mask"] = output_mask
+        output_values = self.model(**model_inputs)
 
         return output_values
 
@@ -201,9 +228,15 @@ class DataModule(L.LightningDataModule):
             drop_last=True,
             pin_memory=True,
             persistent_workers=True if self.cfg.num_workers > 0 else False,
-            prefetch_factor=2 if self.cfg.num_workers > 0 else None,
+            prefetch_factor=(
+                self.cfg.get("prefetch_factor", 2) if self.cfg.num_workers > 0 else None
+            ),
         )
 
+        self.log.info(
+            f"Loading with {self.cfg.num_workers} workers, prefetching "
+            f"{self.cfg.get('prefetch_factor', 2)} batches per worker"
+        )
         self.log.info(f"Training on {len(train_sampler)} samples")
         self.log.info(f"Training on {len(self.train_dataset.get_unit_ids())} units")
         self.log.info(
@@ -232,6 +265,8 @@ class DataModule(L.LightningDataModule):
             collate_fn=collate,
             num_workers=self.cfg.num_workers,
             drop_last=False,
+            pin_memory=True,
+            persistent_workers=True if self.cfg.num_workers > 0 else False,
         )
 
         self.log.info(f"Expecting {len(val_sampler)} validation steps")
@@ -257,6 +292,8 @@ class DataModule(L.LightningDataModule):
             batch_size=batch_size,
             collate_fn=collate,
             num_workers=self.cfg.num_workers,
+            pin_memory=True,
+            persistent_workers=True if self.cfg.num_workers > 0 else False,
         )
 
         self.log.info(f"Testing on {len(test_sampler)} samples")
@@ -271,6 +308,9 @@ def main(cfg: DictConfig):
     # fix random seed, skipped if cfg.seed is None
     seed_everything(cfg.seed)
 
+    # "high" uses TF32 tensor cores for fp32 matmuls on Ampere+ GPUs
+    torch.set_float32_matmul_precision(cfg.get("matmul_precision", "high"))
+
     # setup loggers
     wandb_logger = None
     if cfg.wandb.enable:
@@ -287,6 +327,7 @@ def main(cfg: DictConfig):
 
     # make model and tokenizer
     model = poyo_mp(dim_out=readout_spec.dim)
+    model.gradient_checkpointing = cfg.get("gradient_checkpointing", False)
 
     tokenizer = POYOTokenizer(
         unit_tokenizer=model.unit_emb.tokenizer,
@@ -336,14 +377,28 @@ def main(cfg: DictConfig):
         default_root_dir=cfg.log_dir,
         check_val_every_n_epoch=cfg.eval_epochs,
         max_epochs=cfg.epochs,
+        # Lightning skips the DDP gradient all-reduce on non-final micro-batches
+        accumulate_grad_batches=cfg.get("accumulate_grad_batches", 1),
         log_every_n_steps=1,
         callbacks=callbacks,
-        precision=cfg.precision,
+        precision=resolve_precision(cfg.precision),
         accelerator="gpu" if torch.cuda.is_available() else "cpu",
         devices=cfg.gpus,
         num_nodes=cfg.nodes,
         limit_val_batches=None,  # Ensure no limit on validation batches
         num_sanity_val_steps=cfg.num_sanity_val_steps,
+        # every parameter is used at every step, so DDP can fix its bucket layout
+        # after the first iteration and skip the search for unused parameters;
+        # single-device and CPU runs keep Lightning's default, with no process group
+        strategy=(
+            DDPStrategy(
+                find_unused_parameters=cfg.get("find_unused_parameters", False),
+                static_graph=True,
+                gradient_as_bucket_view=True,
+            )
+            if torch.cuda.is_available() and cfg.gpus * cfg.nodes > 1
+            else "auto"
+        ),
     )
 
     # Train
@@ -12,16 +12,16 @@ from lightning.pytorch.callbacks import (
 )
 from omegaconf import DictConfig
 
+from torch_brain.models import POYOPlusTokenizer
 from torch_brain.registry import MODALITIY_REGISTRY
 from torch_brain.utils import callbacks as tbrain_callbacks
-from torch_brain.utils import seed_everything
-from torch_brain.utils.datamodules import DataModule
-from torch_brain.utils.stitcher import StitchEvaluator
+from torch_brain.utils import resolve_precision, seed_everything
+from torch_brain.utils.stitcher import MultiTaskDecodingStitchEvaluator
 
-from train import POYOTrainWrapper
+from train import DataModule, TrainWrapper
 
-# higher speed on machines with tensor cores
-torch.set_float32_matmul_precision("medium")
+# torch.load(..., mmap=True) requires torch >= 2.1, older versions reject the kwarg
+TORCH_SUPPORTS_MMAP = tuple(map(int, torch.__version__.split(".")[:2])) >= (2, 1)
 
 
 class GradualUnfreezing(L.Callback):
@@ -35,6 +35,18 @@ class GradualUnfreezing(L.Callback):
     _has_been_frozen: bool = False
     frozen_params: Optional[List[nn.Parameter]] = None
 
+    # top-level submodules of POYO+ that are frozen
+    FROZEN_PREFIXES = (
+        "enc_atn",
+        "enc_ffn",
+        "proc_layers",
+        "dec_atn",
+        "dec_ffn",
+        "readout",
+        "token_type_emb",
+        "task_emb",
+    )
+
     def __init__(self, unfreeze_at_epoch: int):
         self.enabled = unfreeze_at_epoch != 0
         self.unfreeze_at_epoch = unfreeze_at_epoch
@@ -45,23 +57,13 @@ class GradualUnfreezing(L.Callback):
         r"""Freeze the model weights, except for the unit and session embeddings, and
         return the list of frozen parameters.
         """
-        layers_to_freeze = [
-            model.enc_atn,
-            model.enc_ffn,
-            model.proc_layers,
-            model.dec_atn,
-            model.dec_ffn,
-            model.readout,
-            model.token_type_emb,
-            model.task_emb,
-        ]
-
+        # named_parameters yields shared parameters once, so each is frozen and
+        # restored exactly once
         frozen_params = []
-        for layer in layers_to_freeze:
-            for param in layer.parameters():
-                if param.requires_grad:
-                    param.requires_grad = False
-                    frozen_params.append(param)
+        for name, param in model.named_parameters():
+            if param.requires_grad and name.split(".", 1)[0] in cls.FROZEN_PREFIXES:
+                param.requires_grad = False
+                frozen_params.append(param)
 
         return frozen_params
 
@@ -92,10 +94,14 @@ def load_model_from_ckpt(model: nn.Module, ckpt_path: str) -> None:
     if ckpt_path is None:
         raise ValueError("Must provide a checkpoint path to finetune the model.")
 
-    ckpt = torch.load(ckpt_path, map_location="cpu")
+    # memory-map the tensors when supported; this is a full Lightning checkpoint
+    # written by train.py, whose LR scheduler state pickles a bound method on
+    # torch < 2.3, so it cannot go through the weights-only unpickler
+    load_kwargs = {"mmap": True} if TORCH_SUPPORTS_MMAP else {}
+    ckpt = torch.load(ckpt_path, map_location="cpu", weights_only=False, **load_kwargs)
     state_dict = ckpt["state_dict"]
     state_dict = {
-        k.replace("model.", ""): v
+        k[len("model.") :]: v
         for k, v in state_dict.items()
         if k.startswith("model.")
     }
@@ -107,6 +113,9 @@ def main(cfg: DictConfig):
     # fix random seed, skipped if cfg.seed is None
     seed_everything(cfg.seed)
 
+    # "high" uses TF32 tensor cores for fp32 matmuls on Ampere+ GPUs
+    torch.set_float32_matmul_precision(cfg.get("matmul_precision", "high"))
+
     # setup loggers
     log = logging.getLogger(__name__)
     wandb_logger = None
@@ -123,9 +132,18 @@ def main(cfg: DictConfig):
     model = hydra.utils.instantiate(cfg.model, readout_specs=MODALITIY_REGISTRY)
     load_model_from_ckpt(model, cfg.ckpt_path)
     log.info(f"Loaded model weights from {cfg.ckpt_path}")
+    model.gradient_checkpointing = cfg.get("gradient_checkpointing", False)
+
+    tokenizer = POYOPlusTokenizer(
+        model.unit_emb.tokenizer,
+        model.session_emb.tokenizer,
+        decoder_registry=MODALITIY_REGISTRY,
+        latent_step=cfg.latent_step,
+        num_latents_per_step=cfg.model.num_latents,
+    )
 
-    # setup data module
-    data_module = DataModule(cfg, model.unit_emb.tokenizer, model.session_emb.tokenizer)
+    # setup data module, shared with train.py so that batches have the same format
+    data_module = DataModule(cfg, tokenizer)
     data_module.setup()
 
     # register units and sessions
@@ -135,17 +153,11 @@ def main(cfg: DictConfig):
     model.session_emb.extend_vocab(session_ids, exist_ok=True)
     model.session_emb.subset_vocab(session_ids)
 
-    # Lightning train wrapper
-    wrapper = POYOTrainWrapper(
-        cfg=cfg,
-        model=model,
-        dataset_config_dict=data_module.get_recording_config_dict(),
-        steps_per_epoch=len(data_module.train_dataloader()),
-    )
+    # Lightning train wrapper, the LR schedule is sized from
+    # trainer.estimated_stepping_batches, so no extra train dataloader is built here
+    wrapper = TrainWrapper(cfg=cfg, model=model)
 
-    evaluator = StitchEvaluator(
-        dataset_config_dict=data_module.get_recording_config_dict()
-    )
+    evaluator = MultiTaskDecodingStitchEvaluator(metrics=data_module.get_metrics())
 
     callbacks = [
         evaluator,
@@ -171,12 +183,14 @@ def main(cfg: DictConfig):
         default_root_dir=cfg.log_dir,
         check_val_every_n_epoch=cfg.eval_epochs,
         max_epochs=cfg.epochs,
+        # Lightning skips the DDP gradient all-reduce on non-final micro-batches
+        accumulate_grad_batches=cfg.get("accumulate_grad_batches", 1),
         log_every_n_steps=1,
         strategy=(
             "ddp_find_unused_parameters_true" if torch.cuda.is_available() else "auto"
         ),
         callbacks=callbacks,
-        precision=cfg.precision,
+        precision=resolve_precision(cfg.precision),
         accelerator="gpu" if torch.cuda.is_available() else "cpu",
         devices=cfg.gpus,
         num_nodes=cfg.nodes,
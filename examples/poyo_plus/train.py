@@ -12,6 +12,7 @@ from lightning.pytorch.callbacks import (
     ModelCheckpoint,
     ModelSummary,
 )
+from lightning.pytorch.strategies import DDPStrategy
 from omegaconf import DictConfig, OmegaConf
 from temporaldata import Data
 from torch.utils.data import DataLoader
@@ -27,13 +28,10 @@ from torch_brain.nn import compute_loss_or_metric
 from torch_brain.registry import MODALITIY_REGISTRY
 from torch_brain.transforms import Compose
 from torch_brain.utils import callbacks as tbrain_callbacks
-from torch_brain.utils import seed_everything
+from torch_brain.utils import resolve_precision, seed_everything
 from torch_brain.utils.stitcher import MultiTaskDecodingStitchEvaluator
 
 
-# higher speed on machines with tensor cores
-torch.set_float32_matmul_precision("medium")
-
 logger = logging.getLogger(__name__)
 
 
@@ -49,15 +47,44 @@ class TrainWrapper(L.LightningModule):
         self.cfg = cfg
         self.save_hyperparameters(OmegaConf.to_container(cfg))
 
-    def configure_optimizers(self):
-        max_lr = self.cfg.optim.base_lr * self.cfg.batch_size  # linear scaling rule
+        if cfg.get("compile", False):
+            compile_kwargs = dict(mode=cfg.get("compile_mode", "default"))
+            if cfg.get("compile_dynamic", None) is not None:
+                compile_kwargs["dynamic"] = cfg.compile_dynamic
+            # compile in place so state dict keys (and checkpoints) are unchanged,
+            # nn.Module.compile only exists from torch 2.2, before that the forward
+            # is compiled on the instance, which also leaves the state dict untouched
+            if hasattr(self.model, "compile"):
+                self.model.compile(**compile_kwargs)
+            else:
+                self.model.forward = torch.compile(self.model.forward, **compile_kwargs)
 
-        optimizer = Lamb(
-            self.model.parameters(),
-            lr=max_lr,
-            weight_decay=self.cfg.optim.weight_decay,
+    def configure_optimizers(self):
+        # linear scaling rule, on the effective batch size
+        max_lr = (
+            self.cfg.optim.base_lr
+            * self.cfg.batch_size
+            * self.cfg.get("accumulate_grad_batches", 1)
         )
 
+        if self.cfg.optim.get("fused", False):
+            # multi-tensor CUDA kernels for the whole step, requires NVIDIA apex
+            from apex.optimizers import FusedLAMB
+
+            optimizer = FusedLAMB(
+                self.model.parameters(),
+                lr=max_lr,
+                weight_decay=self.cfg.optim.weight_decay,
+                # apex clips the global grad norm to 1.0 by default, Lamb does not
+                max_grad_norm=float("inf"),
+            )
+        else:
+            optimizer = Lamb(
+                self.model.parameters(),
+                lr=max_lr,
+                weight_decay=self.cfg.optim.weight_decay,
+            )
+
         scheduler = torch.optim.lr_scheduler.OneCycleLR(
             optimizer,
             max_lr=max_lr,
@@ -86,7 +113,8 @@ class TrainWrapper(L.LightningModule):
         loss = torch.tensor(0, device=self.device, dtype=torch.float32)
         taskwise_loss = {}
         for readout_id in output_values.keys():
-            output = output_values[readout_id]
+            # reduce the loss in fp32 even when the forward runs in bf16/fp16
+            output = output_values[readout_id].float()
             target = target_values[readout_id]
 
             spec = self.model.readout.readout_specs[readout_id]
@@ -123,27 +151,28 @@ class TrainWrapper(L.LightningModule):
         #     self.log(f"targets/mean_{name}", targets.mean())
         #     self.log(f"targets/std_{name}", targets.std())
 
-        unit_index = batch["input_unit_index"].float()
-        self.log("inputs/mean_unit_index", unit_index.mean())
-        self.log("inputs/std_unit_index", unit_index.std())
+        # input statistics are only for monitoring, skip the reductions on most steps
+        if self.global_step % self.cfg.get("log_inputs_every_n_steps", 100) == 0:
+            unit_index = batch["input_unit_index"].float()
+            self.log("inputs/mean_unit_index", unit_index.mean())
+            self.log("inputs/std_unit_index", unit_index.std())
 
         return loss
 
     def validation_step(self, batch, batch_idx):
-        target_values = batch.pop("target_values")
-        batch.pop("target_weights")
-        absolute_starts = batch.pop("absolute_start")
-        session_ids = batch.pop("session_id")
-        eval_mask = batch.pop("eval_mask")
+        # the stitch evaluator reads the targets and metadata from the batch, so leave
+        # it untouched and only pass the model inputs to the forward pass
+        non_model_keys = (
+            "target_values",
+            "target_weights",
+            "absolute_start",
+            "session_id",
+            "eval_mask",
+        )
+        model_inputs = {k: v for k, v in batch.items() if k not in non_model_keys}
 
         # forward pass
-        output_values = self.model(**batch, unpack_output=True)
-
-        # add removed elements back to batch
-        batch["target_values"] = target_values
-        batch["absolute_start"] = absolute_starts
-        batch["session_id"] = session_ids
-        batch["eval_mask"] = eval_mask
+        output_values = self.model(**model_inputs, unpack_output=True)
 
         return output_values
 
@@ -254,9 +283,15 @@ class DataModule(L.LightningDataModule):
             drop_last=True,
             pin_memory=True,
             persistent_workers=True if self.cfg.num_workers > 0 else False,
-            prefetch_factor=2 if self.cfg.num_workers > 0 else None,
+            prefetch_factor=(
+                self.cfg.get("prefetch_factor", 2) if self.cfg.num_workers > 0 else None
+            ),
         )
 
+        self.log.info(
+            f"Loading with {self.cfg.num_workers} workers, prefetching "
+            f"{self.cfg.get('prefetch_factor', 2)} batches per worker"
+        )
         self.log.info(f"Training on {len(train_sampler)} samples")
         self.log.info(f"Training on {len(self.train_dataset.get_unit_ids())} units")
         self.log.info(
@@ -285,6 +320,7 @@ class DataModule(L.LightningDataModule):
             collate_fn=collate,
             num_workers=0,
             drop_last=False,
+            pin_memory=True,
         )
 
         self.log.info(f"Expecting {len(val_sampler)} validation steps")
@@ -311,6 +347,7 @@ class DataModule(L.LightningDataModule):
             batch_size=batch_size,
             collate_fn=collate,
             num_workers=0,
+            pin_memory=True,
         )
 
         self.log.info(f"Testing on {len(test_sampler)} samples")
@@ -325,6 +362,9 @@ def main(cfg: DictConfig):
     # fix random seed, skipped if cfg.seed is None
     seed_everything(cfg.seed)
 
+    # "high" uses TF32 tensor cores for fp32 matmuls on Ampere+ GPUs
+    torch.set_float32_matmul_precision(cfg.get("matmul_precision", "high"))
+
     # setup loggers
     log = logging.getLogger(__name__)
     wandb_logger = None
@@ -340,6 +380,7 @@ def main(cfg: DictConfig):
     # make model
     # TODO: resolve the readout_id from dataset, only build readouts needed
     model = hydra.utils.instantiate(cfg.model, readout_specs=MODALITIY_REGISTRY)
+    model.gradient_checkpointing = cfg.get("gradient_checkpointing", False)
 
     tokenizer = POYOPlusTokenizer(
         model.unit_emb.tokenizer,
@@ -383,12 +424,18 @@ def main(cfg: DictConfig):
         default_root_dir=cfg.log_dir,
         check_val_every_n_epoch=cfg.eval_epochs,
         max_epochs=cfg.epochs,
+        # Lightning skips the DDP gradient all-reduce on non-final micro-batches
+        accumulate_grad_batches=cfg.get("accumulate_grad_batches", 1),
         log_every_n_steps=1,
+        # readouts of tasks missing from a batch get no gradient, so the set of used
+        # parameters changes between steps and the graph cannot be static here
         strategy=(
-            "ddp_find_unused_parameters_true" if torch.cuda.is_available() else "auto"
+            DDPStrategy(find_unused_parameters=True, gradient_as_bucket_view=True)
+            if torch.cuda.is_available()
+            else "auto"
         ),
         callbacks=callbacks,
-        precision=cfg.precision,
+        precision=resolve_precision(cfg.precision),
         accelerator="gpu" if torch.cuda.is_available() else "cpu",
         devices=cfg.gpus,
         num_nodes=cfg.nodes,
@@ -40,6 +40,24 @@ def test_pad8():
         batch, torch.tensor([[1, 2, 3, 0, 0, 0, 0, 0], [4, 5, 0, 0, 0, 0, 0, 0]])
     )
 
+    # padding applied to multi-dimensional torch.Tensors
+    x = pad8(torch.tensor([[1, 2], [3, 4], [5, 6]]))
+    y = pad8(torch.tensor([[7, 8]]))
+
+    batch = collate([x, y])
+    assert batch.shape == (2, 8, 2)
+    assert torch.allclose(batch[0, :3], torch.tensor([[1, 2], [3, 4], [5, 6]]))
+    assert torch.allclose(batch[1, :1], torch.tensor([[7, 8]]))
+    assert (batch[0, 3:] == 0).all() and (batch[1, 1:] == 0).all()
+
+    # no extra padding when the longest sequence is already a multiple of 8
+    x = pad8(np.arange(8))
+    y = pad8(np.arange(5))
+
+    batch = collate([x, y])
+    assert batch.shape == (2, 8)
+    assert torch.allclose(batch[1], torch.tensor([0, 1, 2, 3, 4, 0, 0, 0]))
+
 
 def test_track_mask():
     # padding applied to np.ndarrays
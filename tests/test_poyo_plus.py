@@ -78,6 +78,44 @@ def test_poyo_plus_forward(model):
     assert outputs[0]["cursor_velocity_2d"].shape == (n_out, 2)
 
 
+def test_poyo_plus_gradient_checkpointing(model):
+    batch_size = 2
+    n_in = 10
+    n_latent = 8
+    n_out = 4
+
+    inputs = {
+        "input_unit_index": torch.randint(0, 100, (batch_size, n_in)),
+        "input_timestamps": torch.rand(batch_size, n_in),
+        "input_token_type": torch.randint(0, 4, (batch_size, n_in)),
+        "input_mask": torch.ones(batch_size, n_in, dtype=torch.bool),
+        "latent_index": torch.arange(n_latent).repeat(batch_size, 1),
+        "latent_timestamps": torch.linspace(0, 1, n_latent).repeat(batch_size, 1),
+        "output_session_index": torch.zeros(batch_size, n_out, dtype=torch.long),
+        "output_timestamps": torch.rand(batch_size, n_out),
+        "output_decoder_index": torch.ones(batch_size, n_out, dtype=torch.long),
+    }
+
+    def forward_backward():
+        model.zero_grad()
+        torch.manual_seed(0)
+        loss = model(**inputs)["cursor_velocity_2d"].square().sum()
+        loss.backward()
+        grads = [p.grad.clone() for p in model.proc_layers.parameters()]
+        return loss.detach(), grads
+
+    model.train()
+    loss, grads = forward_backward()
+
+    # recomputing the processing layers must not change the loss or the gradients
+    model.gradient_checkpointing = True
+    ckpt_loss, ckpt_grads = forward_backward()
+
+    assert torch.allclose(loss, ckpt_loss)
+    for grad, ckpt_grad in zip(grads, ckpt_grads):
+        assert torch.allclose(grad, ckpt_grad, atol=1e-6)
+
+
 def test_poyo_plus_tokenizer(task_specs):
     # Create dummy data similar to test_dataset_sim.py
     data = Data(
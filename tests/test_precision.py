@@ -0,0 +1,22 @@
+import torch
+
+from torch_brain.utils import resolve_precision
+
+
+def test_explicit_precision_is_kept():
+    assert resolve_precision("16-mixed") == "16-mixed"
+    assert resolve_precision(32) == 32
+
+
+def test_default_precision_without_cuda(monkeypatch):
+    monkeypatch.setattr(torch.cuda, "is_available", lambda: False)
+    assert resolve_precision(None) == "32-true"
+
+
+def test_default_precision_on_ampere(monkeypatch):
+    monkeypatch.setattr(torch.cuda, "is_available", lambda: True)
+    monkeypatch.setattr(torch.cuda, "get_device_capability", lambda: (8, 0))
+    assert resolve_precision(None) == "bf16-mixed"
+
+    monkeypatch.setattr(torch.cuda, "get_device_capability", lambda: (7, 5))
+    assert resolve_precision(None) == "32-true"
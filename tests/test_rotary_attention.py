@@ -1,6 +1,14 @@
 import pytest
 import torch
 from torch_brain.nn.rotary_attention import RotaryCrossAttention, RotarySelfAttention
+from torch_brain.nn.rotary_embedding import (
+    RotaryEmbedding,
+    apply_rotary_pos_emb,
+    rotary_cos_sin,
+)
+
+# rotary angles have one entry per pair of channels, i.e. half of the default dim_head
+ROTARY_DIM = 32
 
 
 @pytest.fixture
@@ -39,8 +47,8 @@ def test_rotary_cross_attention_shape(device, batch_size, seq_length, dim):
     # Create sample inputs
     x_query = torch.randn(batch_size, seq_length, dim).to(device)
     x_context = torch.randn(batch_size, seq_length * 2, dim).to(device)
-    query_pos_emb = torch.randn(batch_size, seq_length, dim // 2).to(device)
-    context_pos_emb = torch.randn(batch_size, seq_length * 2, dim // 2).to(device)
+    query_pos_emb = torch.randn(batch_size, seq_length, ROTARY_DIM).to(device)
+    context_pos_emb = torch.randn(batch_size, seq_length * 2, ROTARY_DIM).to(device)
 
     # Test forward pass
     output = model(x_query, x_context, query_pos_emb, context_pos_emb)
@@ -54,7 +62,7 @@ def test_rotary_self_attention_shape(device, batch_size, seq_length, dim):
 
     # Create sample inputs
     x = torch.randn(batch_size, seq_length, dim).to(device)
-    pos_emb = torch.randn(batch_size, seq_length, dim // 2).to(device)
+    pos_emb = torch.randn(batch_size, seq_length, ROTARY_DIM).to(device)
 
     # Test forward pass
     output = model(x, pos_emb)
@@ -68,8 +76,8 @@ def test_rotary_cross_attention_mask(device, batch_size, seq_length, dim):
 
     x_query = torch.randn(batch_size, seq_length, dim).to(device)
     x_context = torch.randn(batch_size, seq_length, dim).to(device)
-    query_pos_emb = torch.randn(batch_size, seq_length, dim // 2).to(device)
-    context_pos_emb = torch.randn(batch_size, seq_length, dim // 2).to(device)
+    query_pos_emb = torch.randn(batch_size, seq_length, ROTARY_DIM).to(device)
+    context_pos_emb = torch.randn(batch_size, seq_length, ROTARY_DIM).to(device)
 
     # Create attention mask (mask out second half of context)
     mask = torch.ones(batch_size, seq_length).to(device)
@@ -92,8 +100,8 @@ def test_rotary_cross_attention_varlen(device, dim):
 
     x_query = torch.randn(total_query_len, dim).to(device)
     x_context = torch.randn(total_context_len, dim).to(device)
-    query_pos_emb = torch.randn(total_query_len, dim // 2).to(device)
-    context_pos_emb = torch.randn(total_context_len, dim // 2).to(device)
+    query_pos_emb = torch.randn(total_query_len, ROTARY_DIM).to(device)
+    context_pos_emb = torch.randn(total_context_len, ROTARY_DIM).to(device)
 
     # Skip test if not on CUDA with xformers
     if device == "cpu":
@@ -130,7 +138,7 @@ def test_rotary_self_attention_varlen(device, dim):
     total_len = sum(seq_lengths)
 
     x = torch.randn(total_len, dim).to(device)
-    pos_emb = torch.randn(total_len, dim // 2).to(device)
+    pos_emb = torch.randn(total_len, ROTARY_DIM).to(device)
 
     # Skip test if not on CUDA with xformers
     if device == "cpu":
@@ -151,8 +159,8 @@ def test_invalid_inputs(device, batch_size, seq_length, dim):
     # Test with mismatched batch sizes
     x_query = torch.randn(batch_size, seq_length, dim).to(device)
     x_context = torch.randn(batch_size + 1, seq_length, dim).to(device)
-    query_pos_emb = torch.randn(batch_size, seq_length, dim // 2).to(device)
-    context_pos_emb = torch.randn(batch_size, seq_length, dim // 2).to(device)
+    query_pos_emb = torch.randn(batch_size, seq_length, ROTARY_DIM).to(device)
+    context_pos_emb = torch.randn(batch_size, seq_length, ROTARY_DIM).to(device)
 
     with pytest.raises(RuntimeError):
         model(x_query, x_context, query_pos_emb, context_pos_emb)
@@ -164,8 +172,8 @@ def test_dropout(device, batch_size, seq_length, dim):
 
     x_query = torch.randn(batch_size, seq_length, dim).to(device)
     x_context = torch.randn(batch_size, seq_length, dim).to(device)
-    query_pos_emb = torch.randn(batch_size, seq_length, dim // 2).to(device)
-    context_pos_emb = torch.randn(batch_size, seq_length, dim // 2).to(device)
+    query_pos_emb = torch.randn(batch_size, seq_length, ROTARY_DIM).to(device)
+    context_pos_emb = torch.randn(batch_size, seq_length, ROTARY_DIM).to(device)
 
     # Test that outputs are different in training vs eval mode
     model.train()
@@ -179,3 +187,43 @@ def test_dropout(device, batch_size, seq_length, dim):
 
     assert not torch.allclose(out1, out2)
     assert torch.allclose(out2, out3)
+
+
+def test_rotary_embedding():
+    rotary_emb = RotaryEmbedding(64)
+    timestamps = torch.rand(2, 16)
+    angles = rotary_emb(timestamps)
+    assert angles.shape == (2, 16, 32)
+
+    x = torch.randn(2, 16, 4, 64)
+    out = apply_rotary_pos_emb(angles, x)
+
+    # each pair of adjacent channels is rotated by its own angle
+    x1, x2 = x[..., 0::2], x[..., 1::2]
+    cos, sin = angles.cos().unsqueeze(2), angles.sin().unsqueeze(2)
+    assert torch.allclose(out[..., 0::2], x1 * cos - x2 * sin, atol=1e-6)
+    assert torch.allclose(out[..., 1::2], x1 * sin + x2 * cos, atol=1e-6)
+
+    # rotating by the opposite angles recovers the input
+    assert torch.allclose(apply_rotary_pos_emb(-angles, out), x, atol=1e-5)
+
+
+def test_precomputed_cos_sin(device, batch_size, seq_length, dim):
+    # precomputed (cos, sin) pairs and raw angles give the same outputs
+    self_attn = RotarySelfAttention(dim=dim, rotate_value=True).to(device).eval()
+    cross_attn = RotaryCrossAttention(dim=dim, rotate_value=True).to(device).eval()
+
+    x = torch.randn(batch_size, seq_length, dim).to(device)
+    context = torch.randn(batch_size, seq_length * 2, dim).to(device)
+    pos_emb = torch.randn(batch_size, seq_length, ROTARY_DIM).to(device)
+    context_pos_emb = torch.randn(batch_size, seq_length * 2, ROTARY_DIM).to(device)
+
+    cos_sin = rotary_cos_sin(pos_emb)
+    context_cos_sin = rotary_cos_sin(context_pos_emb)
+
+    assert torch.allclose(self_attn(x, pos_emb), self_attn(x, cos_sin), atol=1e-5)
+    assert torch.allclose(
+        cross_attn(x, context, pos_emb, context_pos_emb),
+        cross_attn(x, context, cos_sin, context_cos_sin),
+        atol=1e-5,
+    )
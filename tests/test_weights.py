@@ -2,7 +2,10 @@ import numpy as np
 import pytest
 from temporaldata import Data, Interval
 
-from torch_brain.utils.weights import resolve_weights_based_on_interval_membership
+from torch_brain.utils.weights import (
+    isin_interval,
+    resolve_weights_based_on_interval_membership,
+)
 
 
 def MockData():
@@ -89,3 +92,28 @@ def test_invalid_interval_type():
 
     with pytest.raises(ValueError, match="Expected an Interval object"):
         resolve_weights_based_on_interval_membership(timestamps, data, config)
+
+
+def test_isin_interval():
+    timestamps = np.linspace(-1.0, 11.0, 1000)
+
+    def reference(interval):
+        return np.any(
+            (timestamps[:, None] >= interval.start)
+            & (timestamps[:, None] < interval.end),
+            axis=1,
+        )
+
+    # sorted, disjoint intervals (including touching and zero-length ones)
+    interval = Interval(
+        start=np.array([0.0, 1.0, 2.0, 2.0, 5.5, 9.0]),
+        end=np.array([0.5, 2.0, 2.0, 3.0, 7.0, 10.0]),
+    )
+    assert np.array_equal(isin_interval(timestamps, interval), reference(interval))
+
+    # overlapping and unsorted intervals
+    interval = Interval(
+        start=np.array([4.0, 2.0, 3.0, 0.0]),
+        end=np.array([6.0, 4.5, 5.0, 1.0]),
+    )
+    assert np.array_equal(isin_interval(timestamps, interval), reference(interval))
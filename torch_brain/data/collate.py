@@ -88,14 +88,13 @@ def pad8_collate_tensor_fn(
     if max_len % 8 == 0:
         return pad_collate_tensor_fn(batch)
 
+    # copy each sample once, straight into a buffer of the rounded-up length, rather
+    # than padding an extra dummy sequence and slicing it off afterwards
     elem = batch[0]
-    batch.append(
-        torch.zeros(
-            (max_len + 8 - (max_len % 8), *elem.shape[1:]), dtype=batch[0].dtype
-        )
-    )
-
-    return pad_collate_tensor_fn(batch)[:-1]
+    out = elem.new_zeros((len(batch), max_len + 8 - (max_len % 8), *elem.shape[1:]))
+    for i, sample in enumerate(batch):
+        out[i, : sample.shape[0]] = sample
+    return out
 
 
 pad8_collate_fn_map = copy.deepcopy(default_collate_fn_map)
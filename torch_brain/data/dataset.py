@@ -20,6 +20,10 @@ from temporaldata import Data, Interval
 class DatasetIndex:
     r"""The dataset can be indexed by specifying a recording id and a start and end time."""
 
+    # one index is created per sample by the samplers, slots keep them small
+    # (dataclass(slots=True) requires python >= 3.10)
+    __slots__ = ("recording_id", "start", "end")
+
     recording_id: str
     start: float
     end: float
@@ -65,6 +69,7 @@ class Dataset(torch.utils.data.Dataset):
     _check_for_data_leakage_flag: bool = True
     _open_files: Optional[Dict[str, h5py.File]] = None
     _data_objects: Optional[Dict[str, Data]] = None
+    _unit_ids: Optional[Dict[str, np.ndarray]] = None
 
     def __init__(
         self,
@@ -114,6 +119,7 @@ class Dataset(torch.utils.data.Dataset):
             recording_id: Data.from_hdf5(f, lazy=True)
             for recording_id, f in self._open_files.items()
         }
+        self._unit_ids = {}
 
     def _close_open_files(self):
         """Closes the open files and deletes open data objects.
@@ -125,12 +131,17 @@ class Dataset(torch.utils.data.Dataset):
             self._open_files = None
 
         self._data_objects = None
+        self._unit_ids = None
 
     def __del__(self):
         self._close_open_files()
 
     def _look_for_files(self, config: omegaconf.DictConfig) -> Dict[str, Dict]:
         recording_dict = {}
+        # a brainset can be used by several selections, so its files are only listed,
+        # and its subject ids only read, once
+        brainset_session_ids = {}
+        brainset_subject_ids = {}
 
         for i, selection_list in enumerate(config):
             selection = selection_list["selection"]
@@ -147,8 +158,11 @@ class Dataset(torch.utils.data.Dataset):
 
                 # Get a list of all the potentially chunks in this dataset.
                 brainset_dir = Path(self.root) / subselection["brainset"]
-                files = list(brainset_dir.glob("*.h5"))
-                session_ids = sorted([f.stem for f in files])
+                if brainset_dir not in brainset_session_ids:
+                    brainset_session_ids[brainset_dir] = sorted(
+                        [f.stem for f in brainset_dir.glob("*.h5")]
+                    )
+                session_ids = list(brainset_session_ids[brainset_dir])
 
                 if len(session_ids) == 0:
                     raise ValueError(
@@ -173,11 +187,15 @@ class Dataset(torch.utils.data.Dataset):
                 # if subject is used for selection, we need to load all the files and
                 # extract the subjects ids
                 if sel_subject is not None or sel_subjects is not None:
-                    all_session_subjects = []
-                    for session_id in session_ids:
-                        with h5py.File(brainset_dir / (session_id + ".h5"), "r") as f:
-                            session_data = Data.from_hdf5(f, lazy=True)
-                            all_session_subjects.append(session_data.subject.id)
+                    if brainset_dir not in brainset_subject_ids:
+                        subject_ids = []
+                        for session_id in session_ids:
+                            filename = brainset_dir / (session_id + ".h5")
+                            with h5py.File(filename, "r") as f:
+                                session_data = Data.from_hdf5(f, lazy=True)
+                                subject_ids.append(session_data.subject.id)
+                        brainset_subject_ids[brainset_dir] = subject_ids
+                    all_session_subjects = brainset_subject_ids[brainset_dir]
 
                 filtered = False
                 if sel_session is not None:
@@ -267,6 +285,18 @@ class Dataset(torch.utils.data.Dataset):
 
         return recording_dict
 
+    def _get_unit_ids(self, recording_id: str) -> np.ndarray:
+        # units are not sliced in time, so the namespaced unit ids of a recording are
+        # built once and reused for every sample instead of being rebuilt in get()
+        unit_ids = self._unit_ids.get(recording_id)
+        if unit_ids is None:
+            data = self._data_objects[recording_id]
+            unit_ids = np.core.defchararray.add(
+                f"{data.brainset}/{data.session}/", data.units.id.astype(str)
+            )
+            self._unit_ids[recording_id] = unit_ids
+        return unit_ids
+
     def get(self, recording_id: str, start: float, end: float):
         r"""This is the main method to extract a slice from a recording. It returns a
         Data object that contains all data for recording :obj:`recording_id` between
@@ -283,9 +313,7 @@ class Dataset(torch.utils.data.Dataset):
         # note there should be no issues as long as the self._data_objects stay lazy
         sample = data.slice(start, end)
 
-        sample.units.id = np.core.defchararray.add(
-            f"{sample.brainset}/{sample.session}/", sample.units.id.astype(str)
-        )
+        sample.units.id = self._get_unit_ids(recording_id)
 
         if self._check_for_data_leakage_flag and self.split is not None:
             sample._check_for_data_leakage(self.split)
@@ -316,9 +344,7 @@ class Dataset(torch.utils.data.Dataset):
         else:
             data = copy.deepcopy(data)
 
-        data.units.id = np.core.defchararray.add(
-            f"{data.brainset}/{data.session}/", data.units.id.astype(str)
-        )
+        data.units.id = self._get_unit_ids(recording_id)
         return data
 
     def get_sampling_intervals(self):
@@ -411,13 +437,7 @@ class Dataset(torch.utils.data.Dataset):
         r"""Returns all unit ids in the dataset."""
         unit_ids_list = []
         for recording_id in self.recording_dict.keys():
-            data = self._data_objects[recording_id]
-            unit_ids = data.units.id
-            unit_ids = np.core.defchararray.add(
-                f"{data.brainset}/{data.session}/",
-                unit_ids.astype(str),
-            )
-            unit_ids_list.extend(unit_ids)
+            unit_ids_list.extend(self._get_unit_ids(recording_id))
         return unit_ids_list
 
     def get_subject_ids(self):
@@ -1,8 +1,9 @@
 from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
 
 import numpy as np
+import torch
 import torch.nn as nn
-from torchtyping import TensorType
+from torch.utils.checkpoint import checkpoint
 from temporaldata import Data
 
 from torch_brain.data import chain, pad8, track_mask8
@@ -13,6 +14,7 @@ from torch_brain.nn import (
     RotaryCrossAttention,
     RotarySelfAttention,
     RotaryEmbedding,
+    rotary_cos_sin,
 )
 from torch_brain.registry import ModalitySpec
 
@@ -52,11 +54,15 @@ class POYO(nn.Module):
         cross_heads: Number of attention heads used in a cross-attention layer
         self_heads: Number of attention heads used in a self-attention layer
         ffn_dropout: Dropout rate for feed-forward networks
+        ffn_approximate: GELU approximation used in the feed-forward networks, either
+            "none" (exact) or "tanh" (cheaper)
         lin_dropout: Dropout rate for linear layers
         atn_dropout: Dropout rate for attention
         emb_init_scale: Scale for embedding initialization
         t_min: Minimum timestamp resolution for rotary embeddings
         t_max: Maximum timestamp resolution for rotary embeddings
+        gradient_checkpointing: If True, the activations of the processing layers
+            are recomputed during the backward pass instead of being stored
         dim_out: Dimension of the output
     """
 
@@ -70,11 +76,13 @@ class POYO(nn.Module):
         cross_heads=1,
         self_heads=8,
         ffn_dropout=0.2,
+        ffn_approximate="none",
         lin_dropout=0.4,
         atn_dropout=0.0,
         emb_init_scale=0.02,
         t_min=1e-4,
         t_max=4.0,
+        gradient_checkpointing=False,
         dim_out,
     ):
         super().__init__()
@@ -97,7 +105,8 @@ class POYO(nn.Module):
             rotate_value=True,
         )
         self.enc_ffn = nn.Sequential(
-            nn.LayerNorm(dim), FeedForward(dim=dim, dropout=ffn_dropout)
+            nn.LayerNorm(dim),
+            FeedForward(dim=dim, dropout=ffn_dropout, approximate=ffn_approximate),
         )
 
         # process layers
@@ -114,7 +123,9 @@ class POYO(nn.Module):
                     ),
                     nn.Sequential(
                         nn.LayerNorm(dim),
-                        FeedForward(dim=dim, dropout=ffn_dropout),
+                        FeedForward(
+                            dim=dim, dropout=ffn_dropout, approximate=ffn_approximate
+                        ),
                     ),
                 )
             )
@@ -128,34 +139,38 @@ class POYO(nn.Module):
             rotate_value=False,
         )
         self.dec_ffn = nn.Sequential(
-            nn.LayerNorm(dim), FeedForward(dim=dim, dropout=ffn_dropout)
+            nn.LayerNorm(dim),
+            FeedForward(dim=dim, dropout=ffn_dropout, approximate=ffn_approximate),
         )
 
         # Output projections + loss
         self.readout = nn.Linear(dim, dim_out)
 
         self.dim = dim
+        self.gradient_checkpointing = gradient_checkpointing
+
+    def _process(self, self_attn, self_ff, latents, latent_timestamp_emb):
+        latents = latents + self.dropout(self_attn(latents, latent_timestamp_emb))
+        latents = latents + self.dropout(self_ff(latents))
+        return latents
 
     def forward(
         self,
         *,
         # input sequence
-        input_unit_index: TensorType["batch", "n_in", int],
-        input_timestamps: TensorType["batch", "n_in", float],
-        input_token_type: TensorType["batch", "n_in", int],
-        input_mask: Optional[TensorType["batch", "n_in", bool]] = None,
+        input_unit_index: torch.Tensor,
+        input_timestamps: torch.Tensor,
+        input_token_type: torch.Tensor,
+        input_mask: Optional[torch.Tensor] = None,
         # latent sequence
-        latent_index: TensorType["batch", "n_latent", int],
-        latent_timestamps: TensorType["batch", "n_latent", float],
+        latent_index: torch.Tensor,
+        latent_timestamps: torch.Tensor,
         # output sequence
-        output_session_index: TensorType["batch", "n_out", int],
-        output_timestamps: TensorType["batch", "n_out", float],
-        output_mask: Optional[TensorType["batch", "n_out", bool]] = None,
+        output_session_index: torch.Tensor,
+        output_timestamps: torch.Tensor,
+        output_mask: Optional[torch.Tensor] = None,
         unpack_output: bool = False,
-    ) -> Union[
-        TensorType["batch", "n_out", "dim_out", float],
-        List[TensorType[..., "dim_out", float]],
-    ]:
+    ) -> Union[torch.Tensor, List[torch.Tensor]]:
         """Forward pass of the POYO model.
 
         The model processes input spike sequences through its encoder-processor-decoder
@@ -197,17 +212,20 @@ class POYO(nn.Module):
                 "`model.session_emb.initialize_vocab(session_ids)`"
             )
 
+        # the cos/sin of the rotary angles are computed once per timestamp set and
+        # shared by the encoder, every processing layer and the decoder
+
         # input
         inputs = self.unit_emb(input_unit_index) + self.token_type_emb(input_token_type)
-        input_timestamp_emb = self.rotary_emb(input_timestamps)
+        input_timestamp_emb = rotary_cos_sin(self.rotary_emb(input_timestamps))
 
         # latents
         latents = self.latent_emb(latent_index)
-        latent_timestamp_emb = self.rotary_emb(latent_timestamps)
+        latent_timestamp_emb = rotary_cos_sin(self.rotary_emb(latent_timestamps))
 
         # outputs
         output_queries = self.session_emb(output_session_index)
-        output_timestamp_emb = self.rotary_emb(output_timestamps)
+        output_timestamp_emb = rotary_cos_sin(self.rotary_emb(output_timestamps))
 
         # encode
         latents = latents + self.enc_atn(
@@ -221,8 +239,19 @@ class POYO(nn.Module):
 
         # process
         for self_attn, self_ff in self.proc_layers:
-            latents = latents + self.dropout(self_attn(latents, latent_timestamp_emb))
-            latents = latents + self.dropout(self_ff(latents))
+            if self.gradient_checkpointing and self.training:
+                latents = checkpoint(
+                    self._process,
+                    self_attn,
+                    self_ff,
+                    latents,
+                    latent_timestamp_emb,
+                    use_reentrant=False,
+                )
+            else:
+                latents = self._process(
+                    self_attn, self_ff, latents, latent_timestamp_emb
+                )
 
         # decode
         output_queries = output_queries + self.dec_atn(
@@ -312,6 +341,15 @@ class POYOTokenizer:
         self.sequence_length = sequence_length
         self.eval = eval
 
+        # the context window is always [0, sequence_length), so the latent tokens are
+        # the same for every sample and only need to be created once
+        self._latent_index, self._latent_timestamps = create_linspace_latent_tokens(
+            0,
+            self.sequence_length,
+            step=self.latent_step,
+            num_latents_per_step=self.num_latents_per_step,
+        )
+
     def __call__(self, data: Data) -> Dict:
         # context window
         start, end = 0, self.sequence_length
@@ -328,25 +366,35 @@ class POYOTokenizer:
             se_timestamps,
         ) = create_start_end_unit_tokens(unit_ids, start, end)
 
-        # append start and end tokens to the spike sequence
-        spike_token_type_index = np.concatenate(
-            [se_token_type_index, np.zeros_like(spike_unit_index)]
-        )
-        spike_unit_index = np.concatenate([se_unit_index, spike_unit_index])
-        spike_timestamps = np.concatenate([se_timestamps, spike_timestamps])
-
         # unit_index is relative to the recording, so we want it to map it to
         # the global unit index
-        local_to_global_map = np.array(self.unit_tokenizer(unit_ids))
-        spike_unit_index = local_to_global_map[spike_unit_index]
+        local_to_global_map = np.fromiter(
+            self.unit_tokenizer(unit_ids), dtype=np.int32, count=len(unit_ids)
+        )
 
-        ### prepare latents
-        latent_index, latent_timestamps = create_linspace_latent_tokens(
-            start,
-            end,
-            step=self.latent_step,
-            num_latents_per_step=self.num_latents_per_step,
+        # prepend the start and end tokens to the spike sequence, filling preallocated
+        # arrays in place; the local unit indices are mapped to global ones directly
+        # into the output, and int32 is enough for embedding indices and halves the
+        # bytes to collate and copy
+        num_se_tokens = len(se_unit_index)
+        num_tokens = num_se_tokens + len(spike_unit_index)
+
+        spike_token_type_index = np.zeros(num_tokens, dtype=np.int32)
+        spike_token_type_index[:num_se_tokens] = se_token_type_index
+
+        global_unit_index = np.empty(num_tokens, dtype=np.int32)
+        np.take(
+            local_to_global_map, se_unit_index, out=global_unit_index[:num_se_tokens]
+        )
+        np.take(
+            local_to_global_map, spike_unit_index, out=global_unit_index[num_se_tokens:]
         )
+        spike_unit_index = global_unit_index
+
+        spike_timestamps = np.concatenate([se_timestamps, spike_timestamps])
+
+        ### prepare latents
+        latent_index, latent_timestamps = self._latent_index, self._latent_timestamps
 
         output_timestamps, output_values, output_weights, eval_mask = (
             prepare_for_readout(data, self.readout_spec)
@@ -356,6 +404,12 @@ class POYOTokenizer:
         output_session_index = self.session_tokenizer(data.session)
         output_session_index = np.repeat(output_session_index, len(output_timestamps))
 
+        # during evaluation, only the outputs within the eval intervals are valid
+        if self.eval and eval_mask is not None:
+            output_mask = pad8(eval_mask)
+        else:
+            output_mask = track_mask8(output_session_index)
+
         batch = {
             # input sequence
             "input_unit_index": pad8(spike_unit_index),
@@ -368,7 +422,7 @@ class POYOTokenizer:
             # output sequence
             "output_session_index": pad8(output_session_index),
             "output_timestamps": pad8(output_timestamps),
-            "output_mask": track_mask8(output_session_index),
+            "output_mask": output_mask,
             # ground truth targets
             "target_values": pad8(output_values),
             "target_weights": pad8(output_weights),
@@ -378,7 +432,4 @@ class POYOTokenizer:
             batch["session_id"] = data.session
             batch["absolute_start"] = data.absolute_start
 
-            if eval_mask is not None:
-                batch["output_mask"] = pad8(eval_mask)
-
         return batch
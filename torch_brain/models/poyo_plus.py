@@ -1,8 +1,9 @@
 from typing import Dict, List, Optional, Tuple
 
 import numpy as np
+import torch
 import torch.nn as nn
-from torchtyping import TensorType
+from torch.utils.checkpoint import checkpoint
 
 from torch_brain.data import chain, pad8, track_mask8
 from torch_brain.nn import (
@@ -13,6 +14,7 @@ from torch_brain.nn import (
     RotaryCrossAttention,
     RotarySelfAttention,
     RotaryEmbedding,
+    rotary_cos_sin,
     prepare_for_multitask_readout,
 )
 from torch_brain.registry import ModalitySpec
@@ -53,11 +55,15 @@ class POYOPlus(nn.Module):
         cross_heads: Number of attention heads used in a cross-attention layer
         self_heads: Number of attention heads used in a self-attention layer
         ffn_dropout: Dropout rate for feed-forward networks
+        ffn_approximate: GELU approximation used in the feed-forward networks, either
+            "none" (exact) or "tanh" (cheaper)
         lin_dropout: Dropout rate for linear layers
         atn_dropout: Dropout rate for attention
         emb_init_scale: Scale for embedding initialization
         t_min: Minimum timestamp resolution for rotary embeddings
         t_max: Maximum timestamp resolution for rotary embeddings
+        gradient_checkpointing: If True, the activations of the processing layers
+            are recomputed during the backward pass instead of being stored
         readout_specs: Specifications for each prediction task
     """
 
@@ -71,11 +77,13 @@ class POYOPlus(nn.Module):
         cross_heads=1,
         self_heads=8,
         ffn_dropout=0.2,
+        ffn_approximate="none",
         lin_dropout=0.4,
         atn_dropout=0.0,
         emb_init_scale=0.02,
         t_min=1e-4,
         t_max=4.0,
+        gradient_checkpointing=False,
         readout_specs: Dict[str, ModalitySpec],
     ):
         super().__init__()
@@ -99,7 +107,8 @@ class POYOPlus(nn.Module):
             rotate_value=True,
         )
         self.enc_ffn = nn.Sequential(
-            nn.LayerNorm(dim), FeedForward(dim=dim, dropout=ffn_dropout)
+            nn.LayerNorm(dim),
+            FeedForward(dim=dim, dropout=ffn_dropout, approximate=ffn_approximate),
         )
 
         # process layers
@@ -116,7 +125,9 @@ class POYOPlus(nn.Module):
                     ),
                     nn.Sequential(
                         nn.LayerNorm(dim),
-                        FeedForward(dim=dim, dropout=ffn_dropout),
+                        FeedForward(
+                            dim=dim, dropout=ffn_dropout, approximate=ffn_approximate
+                        ),
                     ),
                 )
             )
@@ -130,7 +141,8 @@ class POYOPlus(nn.Module):
             rotate_value=False,
         )
         self.dec_ffn = nn.Sequential(
-            nn.LayerNorm(dim), FeedForward(dim=dim, dropout=ffn_dropout)
+            nn.LayerNorm(dim),
+            FeedForward(dim=dim, dropout=ffn_dropout, approximate=ffn_approximate),
         )
 
         # Output projections + loss
@@ -140,24 +152,30 @@ class POYOPlus(nn.Module):
         )
 
         self.dim = dim
+        self.gradient_checkpointing = gradient_checkpointing
+
+    def _process(self, self_attn, self_ff, latents, latent_timestamp_emb):
+        latents = latents + self.dropout(self_attn(latents, latent_timestamp_emb))
+        latents = latents + self.dropout(self_ff(latents))
+        return latents
 
     def forward(
         self,
         *,
         # input sequence
-        input_unit_index: TensorType["batch", "n_in", int],
-        input_timestamps: TensorType["batch", "n_in", float],
-        input_token_type: TensorType["batch", "n_in", int],
-        input_mask: Optional[TensorType["batch", "n_in", bool]] = None,
+        input_unit_index: torch.Tensor,
+        input_timestamps: torch.Tensor,
+        input_token_type: torch.Tensor,
+        input_mask: Optional[torch.Tensor] = None,
         # latent sequence
-        latent_index: TensorType["batch", "n_latent", int],
-        latent_timestamps: TensorType["batch", "n_latent", float],
+        latent_index: torch.Tensor,
+        latent_timestamps: torch.Tensor,
         # output sequence
-        output_session_index: TensorType["batch", "n_out", int],
-        output_timestamps: TensorType["batch", "n_out", float],
-        output_decoder_index: TensorType["batch", "n_out", int],
+        output_session_index: torch.Tensor,
+        output_timestamps: torch.Tensor,
+        output_decoder_index: torch.Tensor,
         unpack_output: bool = False,
-    ) -> Tuple[List[Dict[str, TensorType["*nqueries", "*nchannelsout"]]]]:
+    ) -> Tuple[List[Dict[str, torch.Tensor]]]:
         """Forward pass of the POYO+ model.
 
         The model processes input spike sequences through its encoder-processor-decoder
@@ -197,19 +215,22 @@ class POYOPlus(nn.Module):
                 "`model.session_emb.initialize_vocab(session_ids)`"
             )
 
+        # the cos/sin of the rotary angles are computed once per timestamp set and
+        # shared by the encoder, every processing layer and the decoder
+
         # input
         inputs = self.unit_emb(input_unit_index) + self.token_type_emb(input_token_type)
-        input_timestamp_emb = self.rotary_emb(input_timestamps)
+        input_timestamp_emb = rotary_cos_sin(self.rotary_emb(input_timestamps))
 
         # latents
         latents = self.latent_emb(latent_index)
-        latent_timestamp_emb = self.rotary_emb(latent_timestamps)
+        latent_timestamp_emb = rotary_cos_sin(self.rotary_emb(latent_timestamps))
 
         # outputs
         output_queries = self.session_emb(output_session_index) + self.task_emb(
             output_decoder_index
         )
-        output_timestamp_emb = self.rotary_emb(output_timestamps)
+        output_timestamp_emb = rotary_cos_sin(self.rotary_emb(output_timestamps))
 
         # encode
         latents = latents + self.enc_atn(
@@ -223,8 +244,19 @@ class POYOPlus(nn.Module):
 
         # process
         for self_attn, self_ff in self.proc_layers:
-            latents = latents + self.dropout(self_attn(latents, latent_timestamp_emb))
-            latents = latents + self.dropout(self_ff(latents))
+            if self.gradient_checkpointing and self.training:
+                latents = checkpoint(
+                    self._process,
+                    self_attn,
+                    self_ff,
+                    latents,
+                    latent_timestamp_emb,
+                    use_reentrant=False,
+                )
+            else:
+                latents = self._process(
+                    self_attn, self_ff, latents, latent_timestamp_emb
+                )
 
         # decode
         output_queries = output_queries + self.dec_atn(
@@ -281,6 +313,15 @@ class POYOPlusTokenizer:
 
         self.eval = eval
 
+        # the context window is always [0, sequence_length), so the latent tokens are
+        # the same for every sample and only need to be created once
+        self._latent_index, self._latent_timestamps = create_linspace_latent_tokens(
+            0,
+            self.sequence_length,
+            step=self.latent_step,
+            num_latents_per_step=self.num_latents_per_step,
+        )
+
     def __call__(self, data):
         # context window
         start, end = 0, self.sequence_length
@@ -297,25 +338,35 @@ class POYOPlusTokenizer:
             se_timestamps,
         ) = create_start_end_unit_tokens(unit_ids, start, end)
 
-        # append start and end tokens to the spike sequence
-        spike_token_type_index = np.concatenate(
-            [se_token_type_index, np.zeros_like(spike_unit_index)]
-        )
-        spike_unit_index = np.concatenate([se_unit_index, spike_unit_index])
-        spike_timestamps = np.concatenate([se_timestamps, spike_timestamps])
-
         # unit_index is relative to the recording, so we want it to map it to
         # the global unit index
-        local_to_global_map = np.array(self.unit_tokenizer(unit_ids))
-        spike_unit_index = local_to_global_map[spike_unit_index]
+        local_to_global_map = np.fromiter(
+            self.unit_tokenizer(unit_ids), dtype=np.int32, count=len(unit_ids)
+        )
 
-        ### prepare latents
-        latent_index, latent_timestamps = create_linspace_latent_tokens(
-            start,
-            end,
-            step=self.latent_step,
-            num_latents_per_step=self.num_latents_per_step,
+        # prepend the start and end tokens to the spike sequence, filling preallocated
+        # arrays in place; the local unit indices are mapped to global ones directly
+        # into the output, and int32 is enough for embedding indices and halves the
+        # bytes to collate and copy
+        num_se_tokens = len(se_unit_index)
+        num_tokens = num_se_tokens + len(spike_unit_index)
+
+        spike_token_type_index = np.zeros(num_tokens, dtype=np.int32)
+        spike_token_type_index[:num_se_tokens] = se_token_type_index
+
+        global_unit_index = np.empty(num_tokens, dtype=np.int32)
+        np.take(
+            local_to_global_map, se_unit_index, out=global_unit_index[:num_se_tokens]
         )
+        np.take(
+            local_to_global_map, spike_unit_index, out=global_unit_index[num_se_tokens:]
+        )
+        spike_unit_index = global_unit_index
+
+        spike_timestamps = np.concatenate([se_timestamps, spike_timestamps])
+
+        ### prepare latents
+        latent_index, latent_timestamps = self._latent_index, self._latent_timestamps
 
         ### prepare outputs
         session_index = self.session_tokenizer(data.session)
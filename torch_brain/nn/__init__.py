@@ -3,7 +3,12 @@ from .embedding import Embedding
 from .infinite_vocab_embedding import InfiniteVocabEmbedding
 
 # rotary attention-based models
-from .rotary_embedding import RotaryEmbedding, apply_rotary_pos_emb
+from .rotary_embedding import (
+    RotaryEmbedding,
+    apply_rotary_pos_emb,
+    apply_rotary_cos_sin,
+    rotary_cos_sin,
+)
 from .rotary_attention import RotaryCrossAttention, RotarySelfAttention
 from .feedforward import FeedForward
 
@@ -5,11 +5,19 @@ import torch.nn.functional as F
 class GEGLU(nn.Module):
     """Gated Gaussian Error Linear Unit (GEGLU) activation function, as introduced in
     the paper "GLU Variants Improve Transformer" (https://arxiv.org/abs/2002.05202).
+
+    Args:
+        approximate (str, optional): The GELU approximation to use, either ``"none"``
+            (exact, erf-based) or ``"tanh"``. Defaults to ``"none"``
     """
 
+    def __init__(self, approximate="none"):
+        super().__init__()
+        self.approximate = approximate
+
     def forward(self, x):
         x, gates = x.chunk(2, dim=-1)
-        return x * F.gelu(gates)
+        return x * F.gelu(gates, approximate=self.approximate)
 
 
 class FeedForward(nn.Module):
@@ -19,13 +27,15 @@ class FeedForward(nn.Module):
         dim (int): Input and output dimension
         mult (int, optional): Multiplier for hidden dimension. Defaults to 4
         dropout (float, optional): Dropout probability. Defaults to 0.2
+        approximate (str, optional): The GELU approximation used in the GEGLU
+            activation, either ``"none"`` or ``"tanh"``. Defaults to ``"none"``
     """
 
-    def __init__(self, dim, mult=4, dropout=0.2):
+    def __init__(self, dim, mult=4, dropout=0.2, approximate="none"):
         super().__init__()
         self.net = nn.Sequential(
             nn.Linear(dim, dim * mult * 2),
-            GEGLU(),
+            GEGLU(approximate=approximate),
             nn.Dropout(p=dropout),
             nn.Linear(dim * mult, dim),
         )
@@ -283,7 +283,8 @@ class InfiniteVocabEmbedding(nn.Module):
         """
         if isinstance(words, str):
             return self.vocab[words]
-        return [self.vocab[w] for w in words]
+        # map the bound lookup directly, this is called on every sample by the tokenizers
+        return list(map(self.vocab.__getitem__, words))
 
     def detokenizer(self, index: int):
         r"""Convert a token index to a word.
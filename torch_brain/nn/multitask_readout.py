@@ -6,7 +6,6 @@ import torch.nn as nn
 from torchtyping import TensorType
 from temporaldata import Data
 
-from torch_brain.data.collate import collate, chain, track_batch
 from torch_brain.registry import ModalitySpec, MODALITIY_REGISTRY
 from torch_brain.utils import (
     resolve_weights_based_on_interval_membership,
@@ -236,13 +235,9 @@ def prepare_for_multitask_readout(
             eval_interval = data.get_nested_attribute(eval_interval_key)
             eval_mask[key] = isin_interval(timestamps, eval_interval)
 
-    # chain
-    timestamps, batch = collate(
-        [
-            (chain(timestamps[i]), track_batch(timestamps[i]))
-            for i in range(len(timestamps))
-        ]
-    )
-    readout_index = torch.tensor(readout_index)[batch]
+    # chain the timestamps of all readouts, and track the readout each one belongs to
+    lengths = torch.tensor([len(t) for t in timestamps])
+    timestamps = torch.as_tensor(np.concatenate(timestamps))
+    readout_index = torch.tensor(readout_index).repeat_interleave(lengths)
 
     return timestamps, values, readout_index, weights, eval_mask
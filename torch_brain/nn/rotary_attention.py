@@ -3,7 +3,6 @@ from typing import Optional
 import torch
 import torch.nn.functional as F
 import torch.nn as nn
-from einops import rearrange, repeat
 
 try:
     import xformers.ops as xops
@@ -11,7 +10,7 @@ except ImportError:
     xops = None
 
 
-from torch_brain.nn.rotary_embedding import apply_rotary_pos_emb
+from torch_brain.nn.rotary_embedding import apply_rotary_cos_sin, rotary_cos_sin
 
 
 class RotaryCrossAttention(nn.Module):
@@ -77,14 +76,17 @@ class RotaryCrossAttention(nn.Module):
         Shape:
             - x_query: (B, N_q, D_q)
             - x_context: (B, N_c, D_c)
-            - query_pos_emb: (B, N_q, D_h)
-            - context_pos_emb: (B, N_c, D_h)
+            - query_pos_emb: (B, N_q, D_h / 2)
+            - context_pos_emb: (B, N_c, D_h / 2)
             - context_mask: Optional[Union[None, Tensor[B, N_c]]]
             - Output: (B, N_q, D)
 
             where B is batch size, N_q is query sequence length, N_c is context sequence
             length, D_q is input dimension, D_c is context dimension, H is number of heads,
             and D_h is head dimension.
+
+            The rotary positional embeddings are either rotation angles, or the
+            (cos, sin) pair returned by :func:`rotary_cos_sin`, of the shape above.
         """
         # normalize
         x_query = self.norm(x_query)
@@ -94,20 +96,10 @@ class RotaryCrossAttention(nn.Module):
         q = self.to_q(x_query)
         k, v = self.to_kv(x_context).chunk(2, dim=-1)
 
-        # select attention kernel
-        if xops is not None and x_query.device.type == "cuda":
-            # if xformers is available, use it for attention.
-            # xformers supports attention masks when using the memory efficient attention
-            # kernel, but pytorch does not.
-            rotary_attn_func = rotary_attn_xformers_func
-        else:
-            # otherwise use pytorch's default attention which will determine the best
-            # attention kernel (math, mem_efficient or flash) based on the hardware and
-            # other factors.
-            rotary_attn_func = rotary_attn_pytorch_func
-
-        # apply attention
-        out = rotary_attn_func(
+        # apply attention, pytorch's default attention will determine the best
+        # attention kernel (math, mem_efficient or flash) based on the hardware, the
+        # mask and other factors.
+        out = rotary_attn_pytorch_func(
             query=q,
             key=k,
             value=v,
@@ -142,8 +134,8 @@ class RotaryCrossAttention(nn.Module):
         Shape:
             - x_query: (N_q_total, D)
             - x_context: (N_c_total, D_c)
-            - query_pos_emb: (N_q_total, D_h)
-            - context_pos_emb: (N_c_total, D_h)
+            - query_pos_emb: (N_q_total, D_h / 2)
+            - context_pos_emb: (N_c_total, D_h / 2)
             - query_seqlen: (B,)
             - context_seqlen: (B,)
             - Output: (N_q_total, D)
@@ -151,6 +143,9 @@ class RotaryCrossAttention(nn.Module):
             where N_q_total and N_c_total are the total sequence lengths across the batch,
             B is batch size, D is input dimension, D_c is context dimension, H is number of
             heads, and D_h is head dimension.
+
+            The rotary positional embeddings are either rotation angles, or the
+            (cos, sin) pair returned by :func:`rotary_cos_sin`, of the shape above.
         """
         # normalize
         x_query = self.norm(x_query)
@@ -248,12 +243,15 @@ class RotarySelfAttention(nn.Module):
 
         Shape:
             - x: (B, N, D)
-            - rotary_time_emb: (B, N, D_h)
+            - rotary_time_emb: (B, N, D_h / 2)
             - x_mask: (B, N, N)
             - Output: (B, N, D)
 
             where B is batch size, N is sequence length, D is input dimension,
             and D_h is head dimension.
+
+            The rotary positional embeddings are either rotation angles, or the
+            (cos, sin) pair returned by :func:`rotary_cos_sin`, of the shape above.
         """
         # normalize
         x = self.norm(x)
@@ -261,14 +259,8 @@ class RotarySelfAttention(nn.Module):
         # project to q, k, v
         q, k, v = self.to_qkv(x).chunk(3, dim=-1)
 
-        # select attention kernel
-        if xops is not None and x.device.type == "cuda":
-            rotary_attn_func = rotary_attn_xformers_func
-        else:
-            rotary_attn_func = rotary_attn_pytorch_func
-
         # apply attention
-        out = rotary_attn_func(
+        out = rotary_attn_pytorch_func(
             query=q,
             key=k,
             value=v,
@@ -294,12 +286,15 @@ class RotarySelfAttention(nn.Module):
 
         Shape:
             - x: (N_total, D)
-            - rotary_time_emb: (N_total, D_h)
+            - rotary_time_emb: (N_total, D_h / 2)
             - x_seqlen: (B,)
             - Output: (N_total, D)
 
             where N_total is the total sequence length across the batch,
             B is batch size, D is input dimension, and D_h is head dimension.
+
+            The rotary positional embeddings are either rotation angles, or the
+            (cos, sin) pair returned by :func:`rotary_cos_sin`, of the shape above.
         """
         # normalize
         x = self.norm(x)
@@ -363,31 +358,37 @@ def rotary_attn_pytorch_func(
         query: The query tensor, with shape (b, n_q, (h d))
         key: The key tensor, with shape (b, n_kv, (h d))
         value: The value tensor, with shape (b, n_kv, (h d))
-        q_pos_emb: The query rotary position embedding, with shape (b, n_q, d)
-        kv_pos_emb: The key rotary position embedding, with shape (b, n_kv, d)
+        q_pos_emb: The query rotary position embedding, with shape (b, n_q, d / 2),
+            as angles or a (cos, sin) pair
+        kv_pos_emb: The key rotary position embedding, with shape (b, n_kv, d / 2),
+            as angles or a (cos, sin) pair
         num_heads: The number of attention heads
         dropout_p: The dropout probability
         rotate_value: Whether to rotate the value in addition to the query and key
-        attn_mask: The attention mask, with shape (b, n_kv)
+        attn_mask: The boolean attention mask, with shape (b, n_kv), True for the
+            keys that can be attended to
 
     Returns:
         The output tensor, with shape (b, n_q, (h d))
     """
 
     # default attention expects shape b h n d
-    query = rearrange(query, "b n (h d) -> b h n d", h=num_heads)
-    key = rearrange(key, "b n (h d) -> b h n d", h=num_heads)
-    value = rearrange(value, "b n (h d) -> b h n d", h=num_heads)
+    query = query.unflatten(-1, (num_heads, -1)).transpose(1, 2)
+    key = key.unflatten(-1, (num_heads, -1)).transpose(1, 2)
+    value = value.unflatten(-1, (num_heads, -1)).transpose(1, 2)
 
     # apply rotary embeddings
-    query = apply_rotary_pos_emb(q_pos_emb, query, head_dim=1)
-    key = apply_rotary_pos_emb(kv_pos_emb, key, head_dim=1)
+    q_cos, q_sin, kv_cos, kv_sin = _rotary_cos_sin(
+        q_pos_emb, kv_pos_emb, query.dtype, head_dim=1
+    )
+    query = apply_rotary_cos_sin(q_cos, q_sin, query)
+    key = apply_rotary_cos_sin(kv_cos, kv_sin, key)
     if rotate_value:
-        value = apply_rotary_pos_emb(kv_pos_emb, value, head_dim=1)
+        value = apply_rotary_cos_sin(kv_cos, kv_sin, value)
 
     # attention mask
     if attn_mask is not None:
-        attn_mask = rearrange(attn_mask, "b n -> b () () n")
+        attn_mask = attn_mask[:, None, None, :]
 
     # perform attention, by default will use the optimal attention implementation
     out = F.scaled_dot_product_attention(
@@ -399,78 +400,10 @@ def rotary_attn_pytorch_func(
     )
 
     if rotate_value:
-        out = apply_rotary_pos_emb(-q_pos_emb, out, head_dim=1)
+        out = apply_rotary_cos_sin(q_cos, -q_sin, out)
 
     # return (b, n, (h d), )
-    out = rearrange(out, "b h n d -> b n (h d)")
-    return out
-
-
-def rotary_attn_xformers_func(
-    *,
-    query,
-    key,
-    value,
-    q_pos_emb,
-    kv_pos_emb,
-    attn_mask=None,
-    num_heads: int,
-    dropout_p: float,
-    rotate_value: bool,
-):
-    r"""Wraps the memory efficient attention implementation with rotary embedding
-    application.
-
-    Args:
-        query: The query tensor, with shape (b n (h d))
-        key: The key tensor, with shape (b n (h d))
-        value: The value tensor, with shape (b n (h d))
-        q_pos_emb: The query rotary position embedding, with shape (b n d)
-        kv_pos_emb: The key rotary position embedding, with shape (b n d)
-        attn_mask: The attention mask, with shape (b, n_kv)
-        num_heads: The number of attention heads
-        dropout_p: The dropout probability
-        rotate_value: Whether to rotate the value in addition to the query and key
-
-    Returns:
-        The output tensor, with shape (b n (h d))
-    """
-    # xformers attention expects shape (1, n, h, d)
-    query = rearrange(query, "b n (h d) -> b n h d", h=num_heads)
-    key = rearrange(key, "b n (h d) -> b n h d", h=num_heads)
-    value = rearrange(value, "b n (h d) -> b n h d", h=num_heads)
-
-    query = apply_rotary_pos_emb(q_pos_emb, query, head_dim=2)
-    key = apply_rotary_pos_emb(kv_pos_emb, key, head_dim=2)
-
-    if rotate_value:
-        value = apply_rotary_pos_emb(kv_pos_emb, value, head_dim=2)
-
-    # WARNING: this is very slow, avoid using attn_mask if possible, refer to xformers
-    # documentation
-    attn_mask = (
-        repeat(attn_mask, "b m -> b h n m", h=num_heads, n=query.size(1))
-        if attn_mask is not None
-        else None
-    )
-    attn_bias = (
-        attn_mask.float().masked_fill(attn_mask, float("-inf"))
-        if attn_mask is not None
-        else None
-    )
-
-    out = xops.memory_efficient_attention(
-        query,
-        key,
-        value,
-        attn_bias=attn_bias,
-        p=dropout_p,
-    )
-
-    if rotate_value:
-        out = apply_rotary_pos_emb(-q_pos_emb, out, head_dim=2)
-
-    out = rearrange(out, "b n h d -> b n (h d)")
+    out = out.transpose(1, 2).flatten(-2)
     return out
 
 
@@ -494,8 +427,10 @@ def rotary_attn_xformers_varlen_func(
         query: The query tensor, with shape (n, (h d))
         key: The key tensor, with shape (n, (h d))
         value: The value tensor, with shape (n, (h d))
-        query_pos_emb: The query rotary position embedding, with shape (n, d)
-        key_pos_emb: The key rotary position embedding, with shape (n, d)
+        query_pos_emb: The query rotary position embedding, with shape (n, d / 2),
+            as angles or a (cos, sin) pair
+        key_pos_emb: The key rotary position embedding, with shape (n, d / 2),
+            as angles or a (cos, sin) pair
         num_heads: The number of attention heads
         dropout_p: The dropout probability
         rotate_value: Whether to rotate the value in addition to the query and key
@@ -506,16 +441,20 @@ def rotary_attn_xformers_varlen_func(
         The output tensor, with shape (n, (h d))
     """
     # xformers attention expects shape (1, n, h, d)
-    query = rearrange(query, "n (h d) -> () n h d", h=num_heads)
-    key = rearrange(key, "n (h d) -> () n h d", h=num_heads)
-    value = rearrange(value, "n (h d) -> () n h d", h=num_heads)
+    query = query.unflatten(-1, (num_heads, -1)).unsqueeze(0)
+    key = key.unflatten(-1, (num_heads, -1)).unsqueeze(0)
+    value = value.unflatten(-1, (num_heads, -1)).unsqueeze(0)
 
     # TODO check rotation works
-    query = apply_rotary_pos_emb(q_pos_emb.unsqueeze(0), query)
-    key = apply_rotary_pos_emb(kv_pos_emb.unsqueeze(0), key)
+    # (n, d) -> (n, 1, d), which broadcasts against (1, n, h, d)
+    q_cos, q_sin, kv_cos, kv_sin = _rotary_cos_sin(
+        q_pos_emb, kv_pos_emb, query.dtype, head_dim=1
+    )
+    query = apply_rotary_cos_sin(q_cos, q_sin, query)
+    key = apply_rotary_cos_sin(kv_cos, kv_sin, key)
 
     if rotate_value:
-        value = apply_rotary_pos_emb(kv_pos_emb.unsqueeze(0), value)
+        value = apply_rotary_cos_sin(kv_cos, kv_sin, value)
 
     if isinstance(q_seqlen, torch.Tensor):
         q_seqlen = q_seqlen.tolist()
@@ -538,7 +477,23 @@ def rotary_attn_xformers_varlen_func(
     )
 
     if rotate_value:
-        out = apply_rotary_pos_emb(-q_pos_emb.unsqueeze(0), out)
+        out = apply_rotary_cos_sin(q_cos, -q_sin, out)
 
-    out = rearrange(out, "() n h d -> n (h d)")
+    out = out.squeeze(0).flatten(-2)
     return out
+
+
+def _rotary_cos_sin(q_pos_emb, kv_pos_emb, dtype, head_dim):
+    # the models pass (cos, sin) pairs computed once per forward pass, angles are
+    # only converted here for callers that pass them directly; either way only the
+    # head axis and the dtype cast are added per call, and in self-attention the
+    # query and key share the same pair
+    q_cos, q_sin = rotary_cos_sin(q_pos_emb)
+    q_cos = q_cos.unsqueeze(head_dim).to(dtype)
+    q_sin = q_sin.unsqueeze(head_dim).to(dtype)
+    if kv_pos_emb is q_pos_emb:
+        return q_cos, q_sin, q_cos, q_sin
+    kv_cos, kv_sin = rotary_cos_sin(kv_pos_emb)
+    kv_cos = kv_cos.unsqueeze(head_dim).to(dtype)
+    kv_sin = kv_sin.unsqueeze(head_dim).to(dtype)
+    return q_cos, q_sin, kv_cos, kv_sin
@@ -1,6 +1,5 @@
 import torch
 import torch.nn as nn
-from einops import repeat, rearrange
 
 
 class RotaryEmbedding(nn.Module):
@@ -43,33 +42,58 @@ class RotaryEmbedding(nn.Module):
 
         Args:
             timestamps (torch.Tensor): timestamps tensor.
+
+        Returns:
+            torch.Tensor: The rotation angles, of shape (..., dim // 2), one for each
+            pair of adjacent channels.
         """
-        angles = torch.einsum("..., f -> ... f", timestamps, self.omega)
-        angles = repeat(angles, "... n -> ... (n r)", r=2)
+        # an outer product written as a broadcast multiply rather than an einsum, so
+        # that autocast does not lower it to a bf16/fp16 matmul: the angles reach
+        # 2 * pi / t_min and need full precision before the cos/sin are taken
+        angles = timestamps.unsqueeze(-1) * self.omega
         return angles
 
 
-def rotate_half(x):
-    x = rearrange(x, "... (d r) -> ... d r", r=2)
-    x1, x2 = x.unbind(dim=-1)
-    x = torch.stack((-x2, x1), dim=-1)
-    return rearrange(x, "... d r -> ... (d r)")
-
-
 def apply_rotary_pos_emb(pos_emb, x, head_dim=2):
     r"""Apply the rotary positional embedding to the input data.
 
     Args:
-        pos_emb (torch.Tensor): Angles for different rotations.
+        pos_emb (torch.Tensor or Tuple[torch.Tensor, torch.Tensor]): Angles for
+            different rotations, one for each pair of adjacent channels of ``x``, or
+            their ``(cos, sin)`` as returned by :func:`rotary_cos_sin`.
         x (torch.Tensor): Input data.
         head_dim (int, optional): Dimension of the head. Defaults to 2.
     """
-    dtype = x.dtype
-    # TODO this basically unsqueeze, fix it
-    if head_dim == 1:
-        pos_emb = rearrange(pos_emb, "n ... -> n () ...")
-    elif head_dim == 2:
-        pos_emb = rearrange(pos_emb, "n m ... -> n m () ...")
-
-    x = (x * pos_emb.cos().to(dtype)) + (rotate_half(x) * pos_emb.sin().to(dtype))
-    return x
+    cos, sin = rotary_cos_sin(pos_emb)
+    if head_dim == 1 or head_dim == 2:
+        cos, sin = cos.unsqueeze(head_dim), sin.unsqueeze(head_dim)
+    return apply_rotary_cos_sin(cos.to(x.dtype), sin.to(x.dtype), x)
+
+
+def rotary_cos_sin(pos_emb):
+    r"""Computes the cosine and sine of the rotation angles returned by
+    :class:`RotaryEmbedding`. They can be computed once per forward pass and passed
+    to every rotary attention layer in place of the angles. The inverse rotation is
+    obtained by negating the sine. A ``(cos, sin)`` pair is returned unchanged.
+
+    Args:
+        pos_emb (torch.Tensor): Angles for different rotations.
+    """
+    if isinstance(pos_emb, torch.Tensor):
+        return pos_emb.cos(), pos_emb.sin()
+    return pos_emb
+
+
+def apply_rotary_cos_sin(cos, sin, x):
+    r"""Apply the rotary positional embedding to the input data, given the
+    precomputed output of :func:`rotary_cos_sin`, broadcastable against the pairs of
+    channels of ``x`` and of the same dtype.
+    """
+    # each pair of adjacent channels (x1, x2) is rotated by its own angle, so cos and
+    # sin are half the size of x; addcmul fuses the second product into the sum
+    x1, x2 = x.unflatten(-1, (-1, 2)).unbind(dim=-1)
+    out = torch.stack(
+        (torch.addcmul(x1 * cos, x2, sin, value=-1), torch.addcmul(x2 * cos, x1, sin)),
+        dim=-1,
+    )
+    return out.flatten(-2)
@@ -1,4 +1,5 @@
 from .seed_everything import seed_everything
+from .precision import resolve_precision
 from .tokenizers import create_linspace_latent_tokens, create_start_end_unit_tokens
 from .sinusoidal_encoding import get_sinusoidal_encoding
 from .weights import resolve_weights_based_on_interval_membership, isin_interval
@@ -0,0 +1,29 @@
+import logging
+from typing import Optional, Union
+
+import torch
+
+
+log = logging.getLogger(__name__)
+
+
+def resolve_precision(precision: Optional[Union[str, int]] = None) -> Union[str, int]:
+    """Returns the Lightning training precision to use.
+    Args:
+        precision (str or int, optional): Requested precision. If None, defaults to
+            "bf16-mixed" on CUDA devices with compute capability >= 8.0 (Ampere and
+            newer), which need no gradient scaling, and to "32-true" otherwise.
+    """
+    if precision is None:
+        use_bf16 = (
+            torch.cuda.is_available() and torch.cuda.get_device_capability()[0] >= 8
+        )
+        precision = "bf16-mixed" if use_bf16 else "32-true"
+        log.info("Training precision set to {}.".format(precision))
+
+    if str(precision) in ("16", "16-true"):
+        log.warning(
+            "Training in pure fp16 without gradient scaling can underflow, "
+            "consider 'bf16-mixed' or '16-mixed' instead."
+        )
+    return precision
@@ -156,19 +156,25 @@ class DecodingStitchEvaluator(L.Callback):
 
     def on_validation_batch_end(self, trainer, pl_module, outputs, batch, batch_idx):
         # Update the cache with the predictions, targets, and timestamps
-        batch_size = len(outputs)
-        for i in range(batch_size):
-            mask = batch["output_mask"][i]
-            session_id = batch["session_id"][i]
-            absolute_start = batch["absolute_start"][i]
-
-            pred = outputs[i][mask]
-            target = batch["target_values"][i][mask]
-            timestamps = batch["output_timestamps"][i][mask] + absolute_start
-
-            self.cache[session_id]["pred"].append(pred.detach())
-            self.cache[session_id]["target"].append(target.detach())
-            self.cache[session_id]["timestamps"].append(timestamps.detach())
+        # the valid outputs of the whole batch are selected at once and then split per
+        # sample, rather than masking each sample separately
+        mask = batch["output_mask"]
+        counts = mask.sum(dim=1).tolist()
+        output_timestamps = batch["output_timestamps"]
+        absolute_start = batch["absolute_start"].to(output_timestamps.dtype)
+
+        preds = outputs[mask].detach().split(counts)
+        targets = batch["target_values"][mask].detach().split(counts)
+        timestamps = (output_timestamps + absolute_start[:, None])[mask]
+        timestamps = timestamps.detach().split(counts)
+
+        for session_id, pred, target, timestamp in zip(
+            batch["session_id"], preds, targets, timestamps
+        ):
+            cache = self.cache[session_id]
+            cache["pred"].append(pred)
+            cache["target"].append(target)
+            cache["timestamps"].append(timestamp)
 
     def on_validation_epoch_end(self, trainer, pl_module, prefix="val"):
         # compute metric for each session
@@ -270,17 +276,18 @@ class MultiTaskDecodingStitchEvaluator(L.Callback):
             readout_id = torch_brain.get_modality_by_id(readout_index.item())
 
             token_sample_idx = torch.where(mask)[0]
+            readout_timestamps = batch["output_timestamps"][mask]
+            readout_targets = target_values[readout_id]
+            readout_eval_masks = eval_masks[readout_id]
 
             curr_sample_ptr = self.sample_ptr
 
             for i in torch.unique(token_sample_idx):
+                sample_mask = token_sample_idx == i
                 pred = output_values[i][readout_id]
-                target = target_values[readout_id][token_sample_idx == i]
-                timestamps = (
-                    batch["output_timestamps"][mask][token_sample_idx == i]
-                    + absolute_starts[i]
-                )
-                eval_mask = eval_masks[readout_id][token_sample_idx == i]
+                target = readout_targets[sample_mask]
+                timestamps = readout_timestamps[sample_mask] + absolute_starts[i]
+                eval_mask = readout_eval_masks[sample_mask]
 
                 timestamps = timestamps[eval_mask]
                 pred = pred[eval_mask]
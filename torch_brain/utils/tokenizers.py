@@ -1,5 +1,4 @@
 import numpy as np
-from einops import repeat
 from enum import Enum
 
 
@@ -18,17 +17,17 @@ def create_start_end_unit_tokens(unit_ids, start, end):
         start (float): The start time of the sequence.
         end (float): The end time of the sequence.
     """
-    token_type_index = np.array(
-        [TokenType.START_OF_SEQUENCE.value, TokenType.END_OF_SEQUENCE.value],
-        dtype=np.int64,
+    # every unit gets the same (start, end) pair, so each field is a single tile or
+    # repeat of a constant pattern
+    token_type_index = np.tile(
+        np.array(
+            [TokenType.START_OF_SEQUENCE.value, TokenType.END_OF_SEQUENCE.value],
+            dtype=np.int64,
+        ),
+        len(unit_ids),
     )
-    token_type_index = repeat(token_type_index, "u -> (t u)", t=len(unit_ids))
-
-    unit_index = np.arange(len(unit_ids))
-    unit_index = repeat(unit_index, "u -> (u t)", t=2)
-
-    timestamps = np.array([start, end], dtype=np.float64)
-    timestamps = repeat(timestamps, "u -> (t u)", t=len(unit_ids))
+    unit_index = np.repeat(np.arange(len(unit_ids)), 2)
+    timestamps = np.tile(np.array([start, end], dtype=np.float64), len(unit_ids))
     return token_type_index, unit_index, timestamps
 
 
@@ -49,7 +48,7 @@ def create_linspace_latent_tokens(start, end, step, num_latents_per_step):
     latent_index = np.arange(num_latents_per_step, dtype=np.int64)
 
     num_timestamps = len(latent_timestamps)
-    latent_timestamps = repeat(latent_timestamps, "t -> (t u)", u=len(latent_index))
+    latent_timestamps = np.repeat(latent_timestamps, len(latent_index))
 
-    latent_index = repeat(latent_index, "u -> (t u)", t=num_timestamps)
+    latent_index = np.tile(latent_index, num_timestamps)
     return latent_index, latent_timestamps
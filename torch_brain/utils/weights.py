@@ -15,6 +15,14 @@ def isin_interval(timestamps: np.ndarray, interval: Interval) -> np.ndarray:
     if len(interval) == 0:
         return np.zeros_like(timestamps, dtype=bool)
 
+    start, end = interval.start, interval.end
+    if np.all(start[1:] >= end[:-1]):
+        # sorted and disjoint intervals: the only interval that can contain a timestamp
+        # is the last one starting before it, found by binary search instead of
+        # comparing every timestamp against every interval
+        index = np.searchsorted(start, timestamps, side="right") - 1
+        return (index >= 0) & (timestamps < end[np.maximum(index, 0)])
+
     timestamps_expanded = timestamps[:, None]
     mask = np.any(
         (timestamps_expanded >= interval.start) & (timestamps_expanded < interval.end),